@@ -35,10 +35,14 @@ setup(
     url="https://github.com/TheJacksonLaboratory/omero-cli-transfer",
     install_requires=[
         'ezomero>=3.0.0, <4.0.0',
+        'numpy>=1.22, <2.0.0',
+        'PyYAML>=5.1',
         'ome-types==0.5.1.post1'
     ],
     extras_require={
         "rocrate": ["rocrate>=0.7.0, <1.0.0"],
+        "msgpack": ["msgpack>=1.0.0, <2.0.0"],
+        "zstd": ["zstandard>=0.15.0"],
     },
     python_requires='>=3.8',
 
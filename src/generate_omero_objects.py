@@ -3,109 +3,335 @@
 #
 # Use is subject to license terms supplied in LICENSE.
 
-import ezomero
 from ome_types import to_xml
-from typing import List, Tuple, Union
+from typing import List, Tuple, Union, Dict, Any, Iterable, Optional
+from typing import NamedTuple, DefaultDict, Callable
 from omero.model import DatasetI, IObject, PlateI, WellI, WellSampleI, ImageI
-from omero.gateway import DatasetWrapper
+from omero.model import TagAnnotationI, MapAnnotationI, CommentAnnotationI
+from omero.model import LongAnnotationI, FileAnnotationI, OriginalFileI
+from omero.model import NamedValue, ProjectI, ScreenI, ProjectAnnotationLinkI
+from omero.model import DatasetAnnotationLinkI, ImageAnnotationLinkI
+from omero.model import ScreenAnnotationLinkI, PlateAnnotationLinkI
+from omero.model import WellAnnotationLinkI, ProjectDatasetLinkI
+from omero.model import ScreenPlateLinkI, DatasetImageLinkI, RoiI, LengthI
+from omero.model import PointI, LineI, RectangleI, EllipseI, PolygonI
+from omero.model import PolylineI, LabelI
+from omero.model.enums import UnitsLength
 from ome_types.model import TagAnnotation, MapAnnotation, FileAnnotation, ROI
 from ome_types.model import CommentAnnotation, LongAnnotation, Annotation
 from ome_types.model import Line, Point, Rectangle, Ellipse, Polygon, Shape
 from ome_types.model import Polyline, Label, Project, Screen, Dataset, OME
 from ome_types.model import Image, Plate, XMLAnnotation, AnnotationRef
 from ome_types.model.simple_types import Marker
-from omero.gateway import TagAnnotationWrapper, MapAnnotationWrapper
-from omero.gateway import CommentAnnotationWrapper, LongAnnotationWrapper
-from omero.gateway import FileAnnotationWrapper, OriginalFileWrapper
+from omero.gateway import OriginalFileWrapper
 from omero.sys import Parameters
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring, RStringI, rint
+from omero.rtypes import rstring, RStringI, rint, rlist, rlong, rdouble
 from ezomero import rois
+from session_pool import SessionPool
+from journal import UnpackJournal
 from pathlib import Path
 import xml.etree.cElementTree as ETree
 import os
-import copy
 import re
+import numpy as np
+import warnings
+from contextlib import nullcontext
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+BATCH_SIZE = 1000
+ROI_BATCH_SIZE = 500
+
+# "x1,y1 x2,y2 ..." points strings that are plain number pairs get parsed in
+# bulk; anything else goes through the per-point parser
+POINTS_RE = re.compile(r"[\d.eE+-]+,[\d.eE+-]+,*(?: [\d.eE+-]+,[\d.eE+-]+,*)*")
+
+# omero.model classes for annotations created from each ome_types type
+ANNOTATION_CLASSES = [
+    (TagAnnotation, TagAnnotationI),
+    (MapAnnotation, MapAnnotationI),
+    (CommentAnnotation, CommentAnnotationI),
+    (LongAnnotation, LongAnnotationI),
+    (FileAnnotation, FileAnnotationI),
+    (XMLAnnotation, MapAnnotationI),
+]
+
+# parent, child and link omero.model classes per container link type
+HIERARCHY_LINK_CLASSES = {
+    "ProjectDatasetLink": (ProjectI, DatasetI, ProjectDatasetLinkI),
+    "ScreenPlateLink": (ScreenI, PlateI, ScreenPlateLinkI),
+    "DatasetImageLink": (DatasetI, ImageI, DatasetImageLinkI),
+}
+
+# parent and annotation link omero.model classes per annotated type
+LINK_CLASSES = {
+    "Project": (ProjectI, ProjectAnnotationLinkI),
+    "Dataset": (DatasetI, DatasetAnnotationLinkI),
+    "Image": (ImageI, ImageAnnotationLinkI),
+    "Screen": (ScreenI, ScreenAnnotationLinkI),
+    "Plate": (PlateI, PlateAnnotationLinkI),
+    "Well": (WellI, WellAnnotationLinkI),
+}
+
+
+class TransferXML(NamedTuple):
+    """Contents of one CLITransfer XMLAnnotation, parsed once"""
+    id: str
+    server_path: Optional[str]
+    metadata: Optional[Dict[str, Optional[str]]]
+
+
+class Task(NamedTuple):
+    """
+    A step of ``run_task_graph``: ``func(conn, results)`` runs once all the
+    tasks named in ``deps`` are done, and ``results`` maps finished task
+    names to their return values
+    """
+    func: Callable[[BlitzGateway, Dict[str, Any]], Any]
+    deps: Tuple[str, ...] = ()
+
+
+class TransferIndex(NamedTuple):
+    """Parsed CLITransfer XMLAnnotations by annotation and by owner ID"""
+    by_id: Dict[str, TransferXML]
+    by_owner: Dict[str, List[TransferXML]]
+
+
+def parse_transfer_xml(ann: XMLAnnotation) -> TransferXML:
+    server_path = None
+    metadata = None
+    tree = ETree.fromstring(to_xml(ann.value, canonicalize=True))
+    for el in tree:
+        tag = el.tag.rpartition('}')[2]
+        if tag == "CLITransferServerPath":
+            for el2 in el:
+                if el2.tag.rpartition('}')[2] == "Path":
+                    server_path = el2.text
+        elif tag == "CLITransferMetadata":
+            if metadata is None:
+                metadata = {}
+            for el2 in el:
+                metadata[el2.tag.rpartition('}')[2]] = el2.text
+    return TransferXML(ann.id, server_path, metadata)
+
+
+def index_transfer_annotations(anns: Iterable[Annotation],
+                               owners: Iterable[Any] = ()) -> TransferIndex:
+    """
+    Parse every XMLAnnotation in ``anns`` exactly once, indexing the
+    results by annotation ID and by the ID of each of ``owners``
+    referencing them
+    """
+    by_id = {}
+    for ann in anns:
+        if isinstance(ann, XMLAnnotation):
+            by_id[ann.id] = parse_transfer_xml(ann)
+    by_owner: Dict[str, List[TransferXML]] = {}
+    for obj in owners:
+        for ref in obj.annotation_refs:
+            if ref.id in by_id:
+                by_owner.setdefault(obj.id, []).append(by_id[ref.id])
+    return TransferIndex(by_id, by_owner)
+
+
+def index_by_id(objs: List[Any]) -> Dict[str, Any]:
+    """
+    Map ome_types objects (annotations, ROIs, ...) by their ID, so that
+    references can be resolved without scanning the whole list
+    """
+    return {obj.id: obj for obj in objs}
+
+
+def save_in_batches(objs: List[IObject], conn: BlitzGateway,
+                    on_saved: Optional[Callable[[int, List[int]], None]]
+                    = None) -> List[int]:
+    """
+    Save new objects with one array save per batch and return their ids,
+    in the same order as ``objs``; ``on_saved`` is called with the index
+    of the first object and the new ids of each saved batch
+    """
+    ids = []
+    update = conn.getUpdateService()
+    for i in range(0, len(objs), BATCH_SIZE):
+        new_ids = update.saveAndReturnIds(objs[i:i + BATCH_SIZE],
+                                          conn.SERVICE_OPTS)
+        if on_saved:
+            on_saved(i, new_ids)
+        ids.extend(new_ids)
+    return ids
+
+
+def get_transferred_ids(conn: BlitzGateway, obj_type: str,
+                        obj_ids: List[int]) -> set:
+    """
+    Return the subset of ``obj_ids`` that already carry an annotation in
+    the omero-cli-transfer namespace, using one query per batch of ids
+    """
+    transferred = set()
+    obj_ids = list(set(obj_ids))
+    q = conn.getQueryService()
+    for i in range(0, len(obj_ids), BATCH_SIZE):
+        params = Parameters()
+        params.map = {
+            "ids": rlist([rlong(x) for x in obj_ids[i:i + BATCH_SIZE]]),
+            "ns": rstring('openmicroscopy.org/cli/transfer%'),
+            }
+        results = q.projection(
+            f"SELECT DISTINCT l.parent.id FROM {obj_type}AnnotationLink l"
+            " WHERE l.parent.id IN (:ids)"
+            " AND l.child.ns LIKE :ns",
+            params,
+            conn.SERVICE_OPTS
+            )
+        transferred.update(r[0].val for r in results)
+    return transferred
+
+
+class MergeIndex(NamedTuple):
+    """Current user's containers by name, for --merge lookups"""
+    projects: Dict[str, int]
+    project_datasets: Dict[Tuple[str, str], int]
+    orphan_datasets: Dict[str, int]
+    screens: Dict[str, int]
+
+
+def build_merge_index(conn: BlitzGateway) -> MergeIndex:
+    """
+    Fetch the current user's projects, datasets (with the names of their
+    parent projects) and screens once, indexed by name
+    """
+    q = conn.getQueryService()
+    params = Parameters()
+    params.map = {"uid": rlong(conn.getUser().getId())}
+    projects = {}
+    for r in q.projection(
+            "SELECT p.id, p.name FROM Project p"
+            " WHERE p.details.owner.id = :uid ORDER BY p.id",
+            params, conn.SERVICE_OPTS):
+        projects[r[1].val] = r[0].val
+    project_datasets = {}
+    for r in q.projection(
+            "SELECT p.name, d.id, d.name FROM ProjectDatasetLink l"
+            " JOIN l.parent p JOIN l.child d"
+            " WHERE p.details.owner.id = :uid ORDER BY d.id",
+            params, conn.SERVICE_OPTS):
+        project_datasets[(r[0].val, r[2].val)] = r[1].val
+    orphan_datasets = {}
+    for r in q.projection(
+            "SELECT d.id, d.name FROM Dataset d"
+            " WHERE d.details.owner.id = :uid"
+            " AND NOT EXISTS (SELECT l FROM ProjectDatasetLink l"
+            " WHERE l.child.id = d.id) ORDER BY d.id",
+            params, conn.SERVICE_OPTS):
+        orphan_datasets[r[1].val] = r[0].val
+    screens = {}
+    for r in q.projection(
+            "SELECT s.id, s.name FROM Screen s"
+            " WHERE s.details.owner.id = :uid ORDER BY s.id",
+            params, conn.SERVICE_OPTS):
+        screens[r[1].val] = r[0].val
+    return MergeIndex(projects, project_datasets, orphan_datasets, screens)
+
+
+def create_or_set_containers(ome: OME, conn: BlitzGateway, merge: bool
+                             ) -> Tuple[dict, dict, dict]:
+    """
+    Create (or find, with ``merge``) all Projects, Datasets and Screens,
+    returning the project, dataset and screen ID maps
+    """
+    merge_index = build_merge_index(conn) if merge else None
+    proj_map = create_or_set_projects(ome.projects, conn, merge, merge_index)
+    ds_map = create_or_set_datasets(ome.datasets, ome.projects, conn, merge,
+                                    merge_index)
+    screen_map = create_or_set_screens(ome.screens, conn, merge, merge_index)
+    return proj_map, ds_map, screen_map
 
 
 def create_or_set_projects(pjs: List[Project], conn: BlitzGateway,
-                           merge: bool) -> dict:
+                           merge: bool,
+                           merge_index: Optional[MergeIndex] = None) -> dict:
     pj_map = {}
     if not merge:
         pj_map = create_projects(pjs, conn)
     else:
+        if merge_index is None:
+            merge_index = build_merge_index(conn)
+        missing = []
         for pj in pjs:
-            pj_id = find_project(pj, conn)
-            if not pj_id:
-                pj_id = ezomero.post_project(conn, pj.name, pj.description)
-            pj_map[pj.id] = pj_id
+            pj_id = find_project(pj, merge_index)
+            if pj_id:
+                pj_map[pj.id] = pj_id
+            else:
+                missing.append(pj)
+        pj_map.update(create_merged(missing, merge_index.projects,
+                                    ProjectI, conn))
     return pj_map
 
 
 def create_projects(pjs: List[Project], conn: BlitzGateway) -> dict:
-    pj_map = {}
-    for pj in pjs:
-        pj_id = ezomero.post_project(conn, pj.name, pj.description)
-        pj_map[pj.id] = pj_id
-    return pj_map
+    return create_containers(pjs, ProjectI, conn)
 
 
-def find_project(pj: Project, conn: BlitzGateway) -> int:
-    id = 0
-    my_exp_id = conn.getUser().getId()
-    for p in conn.getObjects("Project", opts={'owner': my_exp_id}):
-        if p.getName() == pj.name:
-            id = p.getId()
-    return id
+def find_project(pj: Project, merge_index: MergeIndex) -> int:
+    return merge_index.projects.get(pj.name, 0)
 
 
-def create_or_set_screens(scrs: List[Screen], conn: BlitzGateway, merge: bool
-                          ) -> dict:
+def create_or_set_screens(scrs: List[Screen], conn: BlitzGateway, merge: bool,
+                          merge_index: Optional[MergeIndex] = None) -> dict:
     scr_map = {}
     if not merge:
         scr_map = create_screens(scrs, conn)
     else:
+        if merge_index is None:
+            merge_index = build_merge_index(conn)
+        missing = []
         for scr in scrs:
-            scr_id = find_screen(scr, conn)
-            if not scr_id:
-                scr_id = ezomero.post_screen(conn, scr.name, scr.description)
-            scr_map[scr.id] = scr_id
+            scr_id = find_screen(scr, merge_index)
+            if scr_id:
+                scr_map[scr.id] = scr_id
+            else:
+                missing.append(scr)
+        scr_map.update(create_merged(missing, merge_index.screens,
+                                     ScreenI, conn))
     return scr_map
 
 
 def create_screens(scrs: List[Screen], conn: BlitzGateway) -> dict:
-    scr_map = {}
-    for scr in scrs:
-        scr_id = ezomero.post_screen(conn, scr.name, scr.description)
-        scr_map[scr.id] = scr_id
-    return scr_map
+    return create_containers(scrs, ScreenI, conn)
 
 
-def find_screen(sc: Screen, conn: BlitzGateway) -> int:
-    id = 0
-    my_exp_id = conn.getUser().getId()
-    for s in conn.getObjects("Screen", opts={'owner': my_exp_id}):
-        if s.getName() == sc.name:
-            id = s.getId()
-    return id
+def find_screen(sc: Screen, merge_index: MergeIndex) -> int:
+    return merge_index.screens.get(sc.name, 0)
 
 
 def create_or_set_datasets(dss: List[Dataset], pjs: List[Project],
-                           conn: BlitzGateway, merge: bool) -> dict:
+                           conn: BlitzGateway, merge: bool,
+                           merge_index: Optional[MergeIndex] = None) -> dict:
     ds_map = {}
     if not merge:
         ds_map = create_datasets(dss, conn)
     else:
+        if merge_index is None:
+            merge_index = build_merge_index(conn)
+        parent_names = DefaultDict(list)
+        for pj in pjs:
+            for dsref in pj.dataset_refs:
+                parent_names[dsref.id].append(pj.name)
+        missing = []
+        missing_orphans = []
         for ds in dss:
-            ds_id = find_dataset(ds, pjs, conn)
-            if not ds_id:
-                dataset = DatasetWrapper(conn, DatasetI())
-                dataset.setName(ds.name)
-                if ds.description is not None:
-                    dataset.setDescription(ds.description)
-                dataset.save()
-                ds_id = dataset.getId()
-            ds_map[ds.id] = ds_id
+            ds_id = find_dataset(ds, parent_names[ds.id], merge_index)
+            if ds_id:
+                ds_map[ds.id] = ds_id
+            elif parent_names[ds.id]:
+                missing.append(ds)
+            else:
+                missing_orphans.append(ds)
+        ds_map.update(create_datasets(missing, conn))
+        ds_map.update(create_merged(missing_orphans,
+                                    merge_index.orphan_datasets,
+                                    DatasetI, conn))
     return ds_map
 
 
@@ -114,174 +340,172 @@ def create_datasets(dss: List[Dataset], conn: BlitzGateway) -> dict:
     Currently doing it the non-ezomero way because ezomero always
     puts "orphan" Datasets in the user's default group
     """
-    ds_map = {}
-    for ds in dss:
-        dataset = DatasetWrapper(conn, DatasetI())
-        dataset.setName(ds.name)
-        if ds.description is not None:
-            dataset.setDescription(ds.description)
-        dataset.save()
-        ds_id = dataset.getId()
-        ds_map[ds.id] = ds_id
-    return ds_map
+    return create_containers(dss, DatasetI, conn)
 
 
-def find_dataset(ds: Dataset, pjs: List[Project], conn: BlitzGateway) -> int:
+def find_dataset(ds: Dataset, parent_names: List[str],
+                 merge_index: MergeIndex) -> int:
     id = 0
-    my_exp_id = conn.getUser().getId()
-    orphan = True
-    for pj in pjs:
-        for dsref in pj.dataset_refs:
-            if dsref.id == ds.id:
-                orphan = False
-    if not orphan:
-        for pj in pjs:
-            for p in conn.getObjects("Project", opts={'owner': my_exp_id}):
-                if p.getName() == pj.name:
-                    for dsref in pj.dataset_refs:
-                        if dsref.id == ds.id:
-                            for ds_rem in p.listChildren():
-                                if ds.name == ds_rem.getName():
-                                    id = ds_rem.getId()
+    if parent_names:
+        for pj_name in parent_names:
+            id = merge_index.project_datasets.get((pj_name, ds.name), id)
     else:
-        for d in conn.getObjects("Dataset", opts={'owner': my_exp_id,
-                                                  'orphaned': True}):
-            if d.getName() == ds.name:
-                id = d.getId()
+        id = merge_index.orphan_datasets.get(ds.name, 0)
     return id
 
 
-def create_annotations(ans: List[Annotation], conn: BlitzGateway, hash: str,
-                       folder: str, figure: bool, img_map: dict,
-                       metadata: List[str]) -> dict:
-    ann_map = {}
+def create_containers(objs: List[Union[Project, Dataset, Screen]],
+                      model_class: Callable[[], IObject],
+                      conn: BlitzGateway) -> dict:
+    """
+    Create one new Project, Dataset or Screen per object in ``objs``
+    with batched array saves, in the group of the current connection
+    """
+    new_objs = []
+    for obj in objs:
+        new_obj = model_class()
+        new_obj.setName(rstring(obj.name))
+        if obj.description is not None:
+            new_obj.setDescription(rstring(obj.description))
+        new_objs.append(new_obj)
+    new_ids = save_in_batches(new_objs, conn)
+    return {obj.id: new_id for obj, new_id in zip(objs, new_ids)}
+
+
+def create_merged(objs: List[Union[Project, Dataset, Screen]],
+                  name_index: Dict[str, int],
+                  model_class: Callable[[], IObject],
+                  conn: BlitzGateway) -> dict:
+    """
+    Create the containers --merge did not find. Objects sharing a name
+    are merged into the first one created, which is added to
+    ``name_index``
+    """
+    first = {}
+    for obj in objs:
+        first.setdefault(obj.name, obj)
+    created = create_containers(list(first.values()), model_class, conn)
+    for name, obj in first.items():
+        name_index[name] = created[obj.id]
+    return {obj.id: name_index[obj.name] for obj in objs}
+
+
+def create_annotations(ans: List[Annotation], transfer_index: TransferIndex,
+                       conn: BlitzGateway, hash: str, folder: str,
+                       figure: bool, img_map: dict, metadata: List[str],
+                       on_saved: Optional[Callable[[dict], None]] = None
+                       ) -> dict:
+    ann_ids = []
+    ann_objs = []
     for an in ans:
         if isinstance(an, TagAnnotation):
-            tag_ann = TagAnnotationWrapper(conn)
-            tag_ann.setValue(an.value)
-            tag_ann.setDescription(an.description)
-            tag_ann.save()
-            ann_map[an.id] = tag_ann.getId()
+            ann_obj = TagAnnotationI()
+            ann_obj.setTextValue(rstring(an.value))
+            if an.description is not None:
+                ann_obj.setDescription(rstring(an.description))
         elif isinstance(an, MapAnnotation):
-            map_ann = MapAnnotationWrapper(conn)
-            namespace = an.namespace
-            map_ann.setNs(namespace)
-            key_value_data = []
-            for v in an.value.ms:
-                key_value_data.append([v.k, v.value])
-            map_ann.setValue(key_value_data)
-            map_ann.save()
-            ann_map[an.id] = map_ann.getId()
+            ann_obj = MapAnnotationI()
+            if an.namespace is not None:
+                ann_obj.setNs(rstring(an.namespace))
+            ann_obj.setMapValue([NamedValue(str(v.k), str(v.value))
+                                 for v in an.value.ms])
         elif isinstance(an, CommentAnnotation):
-            comm_ann = CommentAnnotationWrapper(conn)
-            comm_ann.setValue(an.value)
-            comm_ann.setDescription(an.description)
-            comm_ann.save()
-            ann_map[an.id] = comm_ann.getId()
+            ann_obj = CommentAnnotationI()
+            ann_obj.setTextValue(rstring(an.value))
+            if an.description is not None:
+                ann_obj.setDescription(rstring(an.description))
         elif isinstance(an, LongAnnotation):
-            comm_ann = LongAnnotationWrapper(conn)
-            comm_ann.setValue(an.value)
-            comm_ann.setDescription(an.description)
-            comm_ann.setNs(an.namespace)
-            comm_ann.save()
-            ann_map[an.id] = comm_ann.getId()
+            ann_obj = LongAnnotationI()
+            ann_obj.setLongValue(rlong(an.value))
+            if an.description is not None:
+                ann_obj.setDescription(rstring(an.description))
+            if an.namespace is not None:
+                ann_obj.setNs(rstring(an.namespace))
         elif isinstance(an, FileAnnotation):
             if an.namespace == "omero.web.figure.json":
                 if not figure:
                     continue
                 else:
-                    update_figure_refs(an, ans, img_map, folder)
-            original_file = create_original_file(an, ans, conn, folder)
-            file_ann = FileAnnotationWrapper(conn)
-            file_ann.setDescription(an.description)
-            file_ann.setNs(an.namespace)
-            file_ann.setFile(original_file)
-            file_ann.save()
-            ann_map[an.id] = file_ann.getId()
+                    update_figure_refs(an, transfer_index, img_map, folder)
+            # file contents still need to be uploaded one by one
+            original_file = create_original_file(an, transfer_index, conn,
+                                                 folder)
+            ann_obj = FileAnnotationI()
+            if an.description is not None:
+                ann_obj.setDescription(rstring(an.description))
+            if an.namespace is not None:
+                ann_obj.setNs(rstring(an.namespace))
+            ann_obj.setFile(OriginalFileI(original_file.getId(), False))
         elif isinstance(an, XMLAnnotation):
             # pass if path, use if provenance metadata
-            tree = ETree.fromstring(to_xml(an.value,
-                                           canonicalize=True))
-            is_metadata = False
-            for el in tree:
-                if el.tag.rpartition('}')[2] == "CLITransferMetadata":
-                    is_metadata = True
-            if is_metadata:
-                map_ann = MapAnnotationWrapper(conn)
-                namespace = an.namespace
-                map_ann.setNs(namespace)
-                key_value_data = []
-                if not metadata:
-                    key_value_data.append(['empty_metadata', "True"])
-                else:
-                    key_value_data = parse_xml_metadata(an, metadata, hash)
-                map_ann.setValue(key_value_data)
-                map_ann.save()
-                ann_map[an.id] = map_ann.getId()
+            transfer_xml = transfer_index.by_id.get(an.id)
+            if transfer_xml is None or transfer_xml.metadata is None:
+                continue
+            ann_obj = MapAnnotationI()
+            if an.namespace is not None:
+                ann_obj.setNs(rstring(an.namespace))
+            key_value_data = []
+            if not metadata:
+                key_value_data.append(['empty_metadata', "True"])
+            else:
+                key_value_data = parse_xml_metadata(transfer_xml.metadata,
+                                                    metadata, hash)
+            ann_obj.setMapValue([NamedValue(str(k), str(v))
+                                 for k, v in key_value_data])
+        else:
+            continue
+        ann_ids.append(an.id)
+        ann_objs.append(ann_obj)
+    if on_saved:
+        new_ids = save_in_batches(ann_objs, conn, lambda i, ids: on_saved(
+            dict(zip(ann_ids[i:i + len(ids)], ids))))
+    else:
+        new_ids = save_in_batches(ann_objs, conn)
+    ann_map = dict(zip(ann_ids, new_ids))
     return ann_map
 
 
-def parse_xml_metadata(ann: XMLAnnotation,
+def parse_xml_metadata(fields: Dict[str, Optional[str]],
                        metadata: List[str],
                        hash: str) -> List[List[str]]:
     kv_data = []
-    tree = ETree.fromstring(to_xml(ann.value, canonicalize=True))
-    for el in tree:
-        if el.tag.rpartition('}')[2] == "CLITransferMetadata":
-            for el2 in el:
-                item = el2.tag.rpartition('}')[2]
-                val = el2.text
-                if item == "md5" and "md5" in metadata:
-                    kv_data.append(['md5', hash])
-                if item == "origin_image_id" and "img_id" in metadata:
-                    kv_data.append([item, val])
-                if item == "origin_plate_id" and "plate_id" in metadata:
-                    kv_data.append([item, val])
-                if item == "packing_timestamp" and "timestamp" in metadata:
-                    kv_data.append([item, val])
-                if item == "software" and "software" in metadata:
-                    kv_data.append([item, val])
-                if item == "version" and "version" in metadata:
-                    kv_data.append([item, val])
-                if item == "origin_hostname" and "hostname" in metadata:
-                    kv_data.append([item, val])
-                if item == "original_user" and "orig_user" in metadata:
-                    kv_data.append([item, val])
-                if item == "original_group" and "orig_group" in metadata:
-                    kv_data.append([item, val])
-                if item == "database_id" and "db_id" in metadata:
-                    kv_data.append([item, val])
+    for item, val in fields.items():
+        if item == "md5" and "md5" in metadata:
+            kv_data.append(['md5', hash])
+        if item == "origin_image_id" and "img_id" in metadata:
+            kv_data.append([item, val])
+        if item == "origin_plate_id" and "plate_id" in metadata:
+            kv_data.append([item, val])
+        if item == "packing_timestamp" and "timestamp" in metadata:
+            kv_data.append([item, val])
+        if item == "software" and "software" in metadata:
+            kv_data.append([item, val])
+        if item == "version" and "version" in metadata:
+            kv_data.append([item, val])
+        if item == "origin_hostname" and "hostname" in metadata:
+            kv_data.append([item, val])
+        if item == "original_user" and "orig_user" in metadata:
+            kv_data.append([item, val])
+        if item == "original_group" and "orig_group" in metadata:
+            kv_data.append([item, val])
+        if item == "database_id" and "db_id" in metadata:
+            kv_data.append([item, val])
     return kv_data
 
 
 def get_server_path(anrefs: List[AnnotationRef],
-                    ans: List[Annotation]) -> Union[str, None]:
-    fpath = None
-    xml_ids = []
-    for an in anrefs:
-        for an_loop in ans:
-            if an.id == an_loop.id:
-                if isinstance(an_loop, XMLAnnotation):
-                    xml_ids.append(an_loop.id)
-                else:
-                    continue
-    for an_loop in ans:
-        if an_loop.id in xml_ids:
-            if not fpath:
-                tree = ETree.fromstring(to_xml(an_loop.value,
-                                               canonicalize=True))
-                for el in tree:
-                    if el.tag.rpartition('}')[2] == "CLITransferServerPath":
-                        for el2 in el:
-                            if el2.tag.rpartition('}')[2] == "Path":
-                                fpath = el2.text
-    return fpath
-
-
-def update_figure_refs(ann: FileAnnotation, ans: List[Annotation],
+                    transfer_index: TransferIndex) -> Union[str, None]:
+    for anref in anrefs:
+        transfer_xml = transfer_index.by_id.get(anref.id)
+        if transfer_xml is not None and transfer_xml.server_path:
+            return transfer_xml.server_path
+    return None
+
+
+def update_figure_refs(ann: FileAnnotation, transfer_index: TransferIndex,
                        img_map: dict, folder: str):
     curr_folder = str(Path('.').resolve())
-    fpath = get_server_path(ann.annotation_refs, ans)
+    fpath = get_server_path(ann.annotation_refs, transfer_index)
     if fpath:
         dest_path = str(os.path.join(curr_folder, folder,  '.', fpath))
         with open(dest_path, 'r') as file:
@@ -301,209 +525,293 @@ def update_figure_refs(ann: FileAnnotation, ans: List[Annotation],
     return
 
 
-def create_original_file(ann: FileAnnotation, ans: List[Annotation],
+def create_original_file(ann: FileAnnotation, transfer_index: TransferIndex,
                          conn: BlitzGateway, folder: str
                          ) -> OriginalFileWrapper:
     curr_folder = str(Path('.').resolve())
-    fpath = get_server_path(ann.annotation_refs, ans)
+    fpath = get_server_path(ann.annotation_refs, transfer_index)
     dest_path = str(os.path.join(curr_folder, folder,  '.', fpath))
     ofile = conn.createOriginalFileFromLocalFile(dest_path)
     return ofile
 
 
-def create_plate_map(ome: OME, img_map: dict, conn: BlitzGateway
-                     ) -> Tuple[dict, OME]:
-    newome = copy.deepcopy(ome)
+def match_plates(ome: OME, img_map: dict, transfer_index: TransferIndex,
+                 conn: BlitzGateway,
+                 imported_plates: Optional[Dict[str, List[int]]] = None
+                 ) -> dict:
+    """
+    Match each plate in ``ome`` to its imported plate, or rebuild it from
+    its images when it was imported as loose images
+
+    Plates are matched through the Plate ids the importer reported for the
+    plate's file in ``imported_plates`` (keyed by import filelist path) or,
+    failing that, through the plates holding their imported images. Plates
+    that already carry transfer annotations are never reused.
+    """
     plate_map = {}
-    map_ref_ids = []
+    if imported_plates is None:
+        imported_plates = {}
+    imported_plates = {k.strip('/'): v for k, v in imported_plates.items()}
+    candidates = {}
     for plate in ome.plates:
-        ann_ids = [i.id for i in plate.annotation_refs]
-        for ann in ome.structured_annotations:
-            if (ann.id in ann_ids and
-                    isinstance(ann, XMLAnnotation)):
-                tree = ETree.fromstring(to_xml(ann.value,
-                                               canonicalize=True))
-                is_metadata = False
-                for el in tree:
-                    if el.tag.rpartition('}')[2] == "CLITransferMetadata":
-                        is_metadata = True
-                if not is_metadata:
-                    newome.structured_annotations.remove(ann)
-                    map_ref_ids.append(ann.id)
-                    file_path = get_server_path(plate.annotation_refs,
-                                                ome.structured_annotations)
-                    annref = next(filter(lambda x: x.id == ann.id,
-                                         plate.annotation_refs))
-                    newplate = next(filter(lambda x: x.id == plate.id,
-                                           newome.plates))
-                    newplate.annotation_refs.remove(annref)
-        q = conn.getQueryService()
-        params = Parameters()
+        file_path = None
+        for transfer_xml in transfer_index.by_owner.get(plate.id, []):
+            if transfer_xml.metadata is None:
+                file_path = get_server_path(plate.annotation_refs,
+                                            transfer_index)
         if not file_path:
             raise ValueError(f"Plate ID {plate.id} does not have a \
                              XMLAnnotation with a file path!")
-        path_query = str(file_path).strip('/')
-        if path_query.endswith('mock_folder'):
-            path_query = path_query.rstrip("mock_folder")
-        params.map = {"cpath": rstring('%%%s%%' % path_query)}
-        results = q.projection(
-            "SELECT p.id FROM Plate p"
-            " JOIN p.plateAcquisitions a"
-            " JOIN a.wellSample w"
-            " JOIN w.image i"
-            " JOIN i.fileset fs"
-            " JOIN fs.usedFiles u"
-            " WHERE u.clientPath LIKE :cpath",
-            params,
-            conn.SERVICE_OPTS
-            )
-        all_plate_ids = list(set(sorted([r[0].val for r in results])))
-        plate_ids = []
-        for pl_id in all_plate_ids:
-            anns = ezomero.get_map_annotation_ids(conn, "Plate", pl_id)
-            if not anns:
-                plate_ids.append(pl_id)
-            else:
-                is_annotated = False
-                for ann in anns:
-                    ann_content = conn.getObject("MapAnnotation", ann)
-                    if ann_content.getNs() == \
-                            'openmicroscopy.org/cli/transfer':
-                        is_annotated = True
-                if not is_annotated:
-                    plate_ids.append(pl_id)
+        if file_path.endswith('mock_folder'):
+            file_path = file_path.rstrip("mock_folder")
+        candidates[plate.id] = set(imported_plates.get(file_path.strip('/'),
+                                                       []))
+    unmatched = [plate for plate in ome.plates if not candidates[plate.id]]
+    plate_images = {}
+    for plate in unmatched:
+        plate_images[plate.id] = [img_map[ws.image_ref.id]
+                                  for well in plate.wells
+                                  for ws in well.well_samples
+                                  if ws.image_ref and
+                                  ws.image_ref.id in img_map]
+    image_plates = get_image_plates([i for ids in plate_images.values()
+                                     for i in ids], conn)
+    for plate in unmatched:
+        for img_id in plate_images[plate.id]:
+            candidates[plate.id].update(image_plates.get(img_id, ()))
+    transferred = get_transferred_ids(conn, "Plate",
+                                      [i for ids in candidates.values()
+                                       for i in ids])
+    for plate in ome.plates:
+        plate_ids = candidates[plate.id] - transferred
         if plate_ids:
             # plate was imported as plate
-            plate_id = plate_ids[0]
+            plate_id = min(plate_ids)
         else:
             # plate was imported as images
             plate_id = create_plate_from_images(plate, img_map, conn)
         plate_map[plate.id] = plate_id
-    for p in newome.plates:
-        for ref in p.annotation_refs:
-            if ref.id in map_ref_ids:
-                p.annotation_refs.remove(ref)
-    return plate_map, newome
+    return plate_map
+
+
+def get_image_plates(img_ids: List[int], conn: BlitzGateway
+                     ) -> Dict[int, set]:
+    """
+    Map each image id to the ids of the plates it sits in, using one query
+    per batch of images
+    """
+    image_plates: Dict[int, set] = {}
+    img_ids = list(set(img_ids))
+    q = conn.getQueryService()
+    for i in range(0, len(img_ids), BATCH_SIZE):
+        params = Parameters()
+        params.map = {"ids": rlist([rlong(x) for x in
+                                    img_ids[i:i + BATCH_SIZE]])}
+        results = q.projection(
+            "SELECT ws.image.id, ws.well.plate.id FROM WellSample ws"
+            " WHERE ws.image.id IN (:ids)",
+            params,
+            conn.SERVICE_OPTS
+            )
+        for r in results:
+            image_plates.setdefault(r[0].val, set()).add(r[1].val)
+    return image_plates
 
 
 def create_plate_from_images(plate: Plate, img_map: dict, conn: BlitzGateway
                              ) -> int:
+    """
+    Recreate a plate around images that were imported on their own: the
+    plate is saved first, then its wells and well samples are built in
+    memory and saved in batches
+    """
     plateobj = PlateI()
     plateobj.name = RStringI(plate.name)
-    plateobj = conn.getUpdateService().saveAndReturnObject(plateobj)
-    plate_id = plateobj.getId().getValue()
+    plate_id = conn.getUpdateService().saveAndReturnIds(
+        [plateobj], conn.SERVICE_OPTS)[0]
+    wells = []
     for well in plate.wells:
-        img_ids = []
+        wellobj = WellI()
+        wellobj.plate = PlateI(plate_id, False)
+        wellobj.column = rint(well.column)
+        wellobj.row = rint(well.row)
         for ws in well.well_samples:
-            if ws.image_ref:
-                for imgref in ws.image_ref:
-                    img_ids.append(img_map[imgref[-1]])
-        add_image_to_plate(img_ids, plate_id, well.column,
-                           well.row, conn)
+            if not ws.image_ref:
+                continue
+            try:
+                img_id = img_map[ws.image_ref.id]
+            except KeyError:
+                print(f"Image corresponding to {ws.image_ref.id} not found. "
+                      f"Skipping it in well {well.row}, {well.column}.")
+                continue
+            wsobj = WellSampleI()
+            wsobj.image = ImageI(img_id, False)
+            wsobj.well = wellobj
+            wellobj.addWellSample(wsobj)
+        wells.append(wellobj)
+    save_wells(wells, plate_id, conn)
     return plate_id
 
 
-def add_image_to_plate(image_ids: List[int], plate_id: int, column: int,
-                       row: int, conn: BlitzGateway) -> bool:
+def save_wells(wells: List[WellI], plate_id: int, conn: BlitzGateway):
     """
-    Add the Images to a Plate, creating a new well at the specified column and
-    row
-    NB - This will fail if there is already a well at that point
+    Save new wells in batches; when a batch fails its wells are saved one
+    at a time so that each failing well is reported
+    NB - A well fails if there is already a well at its column and row
     """
-    update_service = conn.getUpdateService()
+    update = conn.getUpdateService()
+    for i in range(0, len(wells), BATCH_SIZE):
+        batch = wells[i:i + BATCH_SIZE]
+        try:
+            update.saveArray(batch, conn.SERVICE_OPTS)
+            continue
+        except Exception:
+            pass
+        for well in batch:
+            try:
+                update.saveArray([well], conn.SERVICE_OPTS)
+            except Exception as e:
+                print(f"Could not create well {well.row.val}, "
+                      f"{well.column.val} in plate {plate_id}: {e}")
+    return
 
-    well = WellI()
-    well.plate = PlateI(plate_id, False)
-    well.column = rint(column)
-    well.row = rint(row)
 
-    try:
-        for image_id in image_ids:
-            image = conn.getObject("Image", image_id)
-            ws = WellSampleI()
-            ws.image = ImageI(image.id, False)
-            ws.well = well
-            well.addWellSample(ws)
-        update_service.saveObject(well)
-    except Exception:
-        return False
-    return True
+def parse_points(points: List[str]) -> List[List[Tuple[float, ...]]]:
+    """
+    Parse many polygon/polyline points strings with one NumPy conversion
+    """
+    parsed: List[Any] = [None] * len(points)
+    fast = [i for i, pts in enumerate(points) if POINTS_RE.fullmatch(pts)]
+    if fast:
+        joined = " ".join(points[i] for i in fast).replace(",", " ")
+        npoints = sum(points[i].count(" ") + 1 for i in fast)
+        try:
+            with warnings.catch_warnings():
+                # NumPy < 2 warns and stops early on a malformed number
+                warnings.simplefilter("ignore", DeprecationWarning)
+                coords = np.fromstring(joined, sep=" ")
+        except ValueError:
+            coords = np.empty(0)
+        if coords.size != 2 * npoints:
+            # let the per-point parser report the malformed number
+            fast = []
+    if fast:
+        coords = coords.tolist()
+        pairs = list(zip(coords[0::2], coords[1::2]))
+        start = 0
+        for i in fast:
+            end = start + points[i].count(" ") + 1
+            parsed[i] = pairs[start:end]
+            start = end
+    for i, pts in enumerate(points):
+        if parsed[i] is None:
+            parsed[i] = []
+            for pt in pts.split(" "):
+                # points sometimes come with a comma at the end...
+                pt = pt.rstrip(",")
+                parsed[i].append(tuple(float(x) for x in pt.split(",")))
+    return parsed
 
 
-def create_shapes(roi: ROI) -> List[Shape]:
-    shapes = []
-    for shape in roi.union:
-        if shape.fill_color:
-            fc = shape.fill_color.as_rgb_tuple()
-            if len(fc) == 3:
-                fill_color = fc + (255,)
-            else:
-                alpha = fc[3] * 255
-                fill_color = fc[0:3] + (int(alpha),)
-        else:
-            fill_color = (0, 0, 0, 0)
-        if shape.stroke_color:
-            sc = shape.stroke_color.as_rgb_tuple()
-            if len(sc) == 3:
-                stroke_color = sc + (255,)
-            else:
-                stroke_color = sc
-        else:
-            stroke_color = (255, 255, 255, 255)
-        if shape.stroke_width:
-            stroke_width = int(shape.stroke_width)
-        else:
-            stroke_width = 1
-        if isinstance(shape, Point):
-            sh = rois.Point(shape.x, shape.y, z=shape.the_z, c=shape.the_c,
-                            t=shape.the_t, label=shape.text,
-                            fill_color=fill_color, stroke_color=stroke_color,
-                            stroke_width=stroke_width)
-        elif isinstance(shape, Line):
-            if shape.marker_start == Marker.ARROW:
-                mk_start = "Arrow"
+def convert_colors(shapes: List[Shape]) -> Tuple[List[tuple], List[tuple]]:
+    """
+    Convert the fill and stroke colors of many shapes to the RGBA tuples
+    used by ezomero, as arrays
+    """
+    fill = np.array([int(sh.fill_color) if sh.fill_color else 0
+                     for sh in shapes], dtype=np.int64) & 0xFFFFFFFF
+    stroke = np.array([int(sh.stroke_color) if sh.stroke_color else 0
+                       for sh in shapes], dtype=np.int64) & 0xFFFFFFFF
+    has_fill = np.array([bool(sh.fill_color) for sh in shapes], dtype=bool)
+    has_stroke = np.array([bool(sh.stroke_color) for sh in shapes],
+                          dtype=bool)
+    fill_rgba = np.stack([fill >> 24 & 255, fill >> 16 & 255,
+                          fill >> 8 & 255, fill & 255], axis=-1)
+    # no fill color means transparent black
+    fill_rgba[~has_fill] = 0
+    stroke_rgb = np.stack([stroke >> 24 & 255, stroke >> 16 & 255,
+                           stroke >> 8 & 255], axis=-1)
+    # no stroke color means opaque white
+    stroke_rgb[~has_stroke] = 255
+    stroke_alpha = stroke & 255
+    # translucent stroke colors keep their 0-1 alpha, as in as_rgb_tuple
+    stroke_opaque = (stroke_alpha == 255) | ~has_stroke
+    fill_colors = list(map(tuple, fill_rgba.tolist()))
+    stroke_colors = []
+    for rgb, alpha, opaque in zip(stroke_rgb.tolist(), stroke_alpha.tolist(),
+                                  stroke_opaque.tolist()):
+        stroke_colors.append(tuple(rgb) + ((255,) if opaque
+                                           else (alpha / 255,)))
+    return fill_colors, stroke_colors
+
+
+def create_roi_shapes(rois_: List[ROI]) -> List[List[rois.ezShape]]:
+    """
+    Convert the shapes of a set of ROIs to ezomero shapes, parsing points
+    and colors for the whole set at once
+    """
+    all_shapes = [shape for roi in rois_ for shape in roi.union]
+    fill_colors, stroke_colors = convert_colors(all_shapes)
+    poly_shapes = [shape for shape in all_shapes
+                   if isinstance(shape, (Polygon, Polyline))]
+    poly_points = dict(zip(map(id, poly_shapes),
+                           parse_points([sh.points for sh in poly_shapes])))
+    shape_iter = iter(zip(all_shapes, fill_colors, stroke_colors))
+    roi_shapes = []
+    for roi in rois_:
+        shapes = []
+        for _ in range(len(roi.union)):
+            shape, fill_color, stroke_color = next(shape_iter)
+            if shape.stroke_width:
+                stroke_width = int(shape.stroke_width)
             else:
-                mk_start = str(shape.marker_start)
-            if shape.marker_end == Marker.ARROW:
-                mk_end = "Arrow"
+                stroke_width = 1
+            if isinstance(shape, Point):
+                sh = rois.Point(shape.x, shape.y, z=shape.the_z,
+                                c=shape.the_c, t=shape.the_t,
+                                label=shape.text, fill_color=fill_color,
+                                stroke_color=stroke_color,
+                                stroke_width=stroke_width)
+            elif isinstance(shape, Line):
+                if shape.marker_start == Marker.ARROW:
+                    mk_start = "Arrow"
+                else:
+                    mk_start = str(shape.marker_start)
+                if shape.marker_end == Marker.ARROW:
+                    mk_end = "Arrow"
+                else:
+                    mk_end = str(shape.marker_end)
+                sh = rois.Line(shape.x1, shape.y1, shape.x2, shape.y2,
+                               z=shape.the_z, c=shape.the_c, t=shape.the_t,
+                               label=shape.text, markerStart=mk_start,
+                               markerEnd=mk_end)
+            elif isinstance(shape, Rectangle):
+                sh = rois.Rectangle(shape.x, shape.y, shape.width,
+                                    shape.height, z=shape.the_z,
+                                    c=shape.the_c, t=shape.the_t,
+                                    label=shape.text)
+            elif isinstance(shape, Ellipse):
+                sh = rois.Ellipse(shape.x, shape.y, shape.radius_x,
+                                  shape.radius_y, z=shape.the_z,
+                                  c=shape.the_c, t=shape.the_t,
+                                  label=shape.text)
+            elif isinstance(shape, Polygon):
+                sh = rois.Polygon(poly_points[id(shape)], z=shape.the_z,
+                                  c=shape.the_c, t=shape.the_t,
+                                  label=shape.text)
+            elif isinstance(shape, Polyline):
+                sh = rois.Polyline(poly_points[id(shape)], z=shape.the_z,
+                                   c=shape.the_c, t=shape.the_t,
+                                   label=shape.text)
+            elif isinstance(shape, Label):
+                sh = rois.Label(shape.x, shape.y, z=shape.the_z,
+                                c=shape.the_c, t=shape.the_t,
+                                label=shape.text, fontSize=shape.font_size)
             else:
-                mk_end = str(shape.marker_end)
-            sh = rois.Line(shape.x1, shape.y1, shape.x2, shape.y2,
-                           z=shape.the_z, c=shape.the_c, t=shape.the_t,
-                           label=shape.text, markerStart=mk_start,
-                           markerEnd=mk_end)
-        elif isinstance(shape, Rectangle):
-            sh = rois.Rectangle(shape.x, shape.y, shape.width, shape.height,
-                                z=shape.the_z, c=shape.the_c, t=shape.the_t,
-                                label=shape.text)
-        elif isinstance(shape, Ellipse):
-            sh = rois.Ellipse(shape.x, shape.y, shape.radius_x, shape.radius_y,
-                              z=shape.the_z, c=shape.the_c, t=shape.the_t,
-                              label=shape.text)
-        elif isinstance(shape, Polygon):
-            points = []
-            for pt in shape.points.split(" "):
-                # points sometimes come with a comma at the end...
-                pt = pt.rstrip(",")
-                points.append(tuple(float(x) for x in pt.split(",")))
-            sh = rois.Polygon(points, z=shape.the_z, c=shape.the_c,
-                              t=shape.the_t, label=shape.text)
-        elif isinstance(shape, Polyline):
-            points = []
-            for pt in shape.points.split(" "):
-                # points sometimes come with a comma at the end...
-                pt = pt.rstrip(",")
-                points.append(tuple(float(x) for x in pt.split(",")))
-            sh = rois.Polyline(points, z=shape.the_z, c=shape.the_c,
-                               t=shape.the_t, label=shape.text)
-        elif isinstance(shape, Label):
-            sh = rois.Label(shape.x, shape.y, z=shape.the_z, c=shape.the_c,
-                            t=shape.the_t, label=shape.text,
-                            fontSize=shape.font_size)
-        else:
-            continue
-        shapes.append(sh)
-    return shapes
+                continue
+            shapes.append(sh)
+        roi_shapes.append(shapes)
+    return roi_shapes
 
 
 def _int_to_rgba(omero_val: int) -> Tuple[int, int, int, int]:
@@ -518,178 +826,570 @@ def _int_to_rgba(omero_val: int) -> Tuple[int, int, int, int]:
     return (r, g, b, a)
 
 
-def create_rois(rois: List[ROI], imgs: List[Image], img_map: dict,
-                conn: BlitzGateway):
+def _rgba_to_int(color: Tuple[int, int, int, int]) -> int:
+    """ Helper function returning the color as an Integer in RGBA encoding """
+    r, g, b, a = color
+    rgba_int = (r << 24) + (g << 16) + (b << 8) + a
+    if rgba_int > (2**31-1):  # convert to signed 32-bit int
+        rgba_int = rgba_int - 2**32
+    return rgba_int
+
+
+def create_omero_shape(shape: rois.ezShape) -> IObject:
+    """
+    Convert an ezomero shape into an unsaved omero.model shape, the same
+    way ``ezomero.post_roi`` does
+    """
+    if isinstance(shape, rois.Point):
+        omero_shape = PointI()
+        omero_shape.x = rdouble(shape.x)
+        omero_shape.y = rdouble(shape.y)
+    elif isinstance(shape, rois.Line):
+        omero_shape = LineI()
+        omero_shape.x1 = rdouble(shape.x1)
+        omero_shape.x2 = rdouble(shape.x2)
+        omero_shape.y1 = rdouble(shape.y1)
+        omero_shape.y2 = rdouble(shape.y2)
+        if shape.markerStart is not None:
+            omero_shape.markerStart = rstring(shape.markerStart)
+        if shape.markerEnd is not None:
+            omero_shape.markerEnd = rstring(shape.markerEnd)
+    elif isinstance(shape, rois.Rectangle):
+        omero_shape = RectangleI()
+        omero_shape.x = rdouble(shape.x)
+        omero_shape.y = rdouble(shape.y)
+        omero_shape.width = rdouble(shape.width)
+        omero_shape.height = rdouble(shape.height)
+    elif isinstance(shape, rois.Ellipse):
+        omero_shape = EllipseI()
+        omero_shape.x = rdouble(shape.x)
+        omero_shape.y = rdouble(shape.y)
+        omero_shape.radiusX = rdouble(shape.x_rad)
+        omero_shape.radiusY = rdouble(shape.y_rad)
+    elif isinstance(shape, (rois.Polygon, rois.Polyline)):
+        if isinstance(shape, rois.Polygon):
+            omero_shape = PolygonI()
+        else:
+            omero_shape = PolylineI()
+        points_str = "".join("".join([str(x), ',', str(y), ' '])
+                             for x, y in shape.points).rstrip()
+        omero_shape.points = rstring(points_str)
+    elif isinstance(shape, rois.Label):
+        omero_shape = LabelI()
+        omero_shape.x = rdouble(shape.x)
+        omero_shape.y = rdouble(shape.y)
+        omero_shape.fontSize = LengthI(shape.fontSize, UnitsLength.POINT)
+    else:
+        raise TypeError('The shape passed for the roi is not a valid shape '
+                        'type')
+    if shape.z is not None:
+        omero_shape.theZ = rint(shape.z)
+    if shape.c is not None:
+        omero_shape.theC = rint(shape.c)
+    if shape.t is not None:
+        omero_shape.theT = rint(shape.t)
+    if shape.label is not None:
+        omero_shape.setTextValue(rstring(shape.label))
+    if shape.fill_color is not None:
+        omero_shape.setFillColor(rint(_rgba_to_int(shape.fill_color)))
+    else:
+        omero_shape.setFillColor(rint(_rgba_to_int((0, 0, 0, 0))))
+    if shape.stroke_color is not None:
+        omero_shape.setStrokeColor(rint(_rgba_to_int(shape.stroke_color)))
+    else:
+        omero_shape.setStrokeColor(rint(_rgba_to_int((255, 255, 0, 255))))
+    if shape.stroke_width is not None:
+        omero_shape.setStrokeWidth(LengthI(shape.stroke_width,
+                                           UnitsLength.PIXEL))
+    else:
+        omero_shape.setStrokeWidth(LengthI(1.0, UnitsLength.PIXEL))
+    return omero_shape
+
+
+def create_rois(roi_index: Dict[str, ROI], imgs: List[Image], img_map: dict,
+                conn: BlitzGateway, done: Optional[Dict[str, int]] = None,
+                on_saved: Optional[Callable[[Dict[str, int]], None]] = None):
+    """
+    Create the ROIs of ``imgs`` on their mapped images
+
+    Each ROI is keyed by ``<image id>/<ROI id>``. Keys in ``done`` are
+    skipped, and ``on_saved`` is called with the keys (and destination
+    image ids) of each saved batch.
+    """
+    if done is None:
+        done = {}
+    img_rois = []
     for img in imgs:
-        for roiref in img.roi_refs:
-            roi = next(filter(lambda x: x.id == roiref.id, rois))
-            shapes = create_shapes(roi)
+        if not img.roi_refs:
+            continue
+        try:
             img_id_dest = img_map[img.id]
-            ezomero.post_roi(conn, img_id_dest, shapes, name=roi.name,
-                             description=roi.description)
+        except KeyError:
+            print(f"Image corresponding to {img.id} not found. Skipping "
+                  "its ROIs.")
+            continue
+        for roiref in img.roi_refs:
+            key = f"{img.id}/{roiref.id}"
+            if key not in done:
+                img_rois.append((key, img_id_dest, roi_index[roiref.id]))
+    roi_shapes = create_roi_shapes([roi for _, _, roi in img_rois])
+    roi_objs = []
+    roi_keys = {}
+    for (key, img_id_dest, roi), shapes in zip(img_rois, roi_shapes):
+        roi_obj = RoiI()
+        if roi.name is not None:
+            roi_obj.setName(rstring(roi.name))
+        if roi.description is not None:
+            roi_obj.setDescription(rstring(roi.description))
+        for shape in shapes:
+            roi_obj.addShape(create_omero_shape(shape))
+        roi_obj.setImage(ImageI(img_id_dest, False))
+        roi_objs.append(roi_obj)
+        roi_keys[id(roi_obj)] = (key, img_id_dest)
+
+    def saved_batch(objs: List[IObject]):
+        if on_saved:
+            on_saved(dict(roi_keys[id(o)] for o in objs))
+
+    total = len(roi_objs)
+    saved = 0
+    for i in range(0, total, ROI_BATCH_SIZE):
+        saved += save_roi_batch(roi_objs[i:i + ROI_BATCH_SIZE], conn,
+                                saved_batch)
+        print(f"Created {saved}/{total} ROIs")
     return
 
 
+def save_roi_batch(roi_objs: List[IObject], conn: BlitzGateway,
+                   on_saved: Optional[Callable[[List[IObject]], None]] = None
+                   ) -> int:
+    """
+    Save a batch of ROIs with one array save, splitting it in halves and
+    retrying if the save fails; a single ROI that fails is re-raised.
+    ``on_saved`` is called with each part that was saved.
+    """
+    try:
+        conn.getUpdateService().saveArray(roi_objs, conn.SERVICE_OPTS)
+    except Exception:
+        if len(roi_objs) == 1:
+            raise
+        half = len(roi_objs) // 2
+        print(f"Saving {len(roi_objs)} ROIs failed, retrying in smaller "
+              "batches")
+        return (save_roi_batch(roi_objs[:half], conn, on_saved) +
+                save_roi_batch(roi_objs[half:], conn, on_saved))
+    if on_saved:
+        on_saved(roi_objs)
+    return len(roi_objs)
+
+
 def link_datasets(ome: OME, proj_map: dict, ds_map: dict, conn: BlitzGateway):
+    pairs = []
     for proj in ome.projects:
         proj_id = proj_map[proj.id]
-        proj_obj = conn.getObject("Project", proj_id)
-        existing_ds = []
-        for dataset in proj_obj.listChildren():
-            existing_ds.append(dataset.getId())
-        ds_ids = []
         for ds in proj.dataset_refs:
-            ds_id = ds_map[ds.id]
-            if ds_id not in existing_ds:
-                ds_ids.append(ds_id)
-        ezomero.link_datasets_to_project(conn, ds_ids, proj_id)
+            pairs.append((proj_id, ds_map[ds.id]))
+    link_children(pairs, "ProjectDatasetLink", conn)
     return
 
 
 def link_plates(ome: OME, screen_map: dict, plate_map: dict,
                 conn: BlitzGateway):
+    pairs = []
     for screen in ome.screens:
         screen_id = screen_map[screen.id]
-        scr_obj = conn.getObject("Screen", screen_id)
-        existing_pl = []
-        for pl in scr_obj.listChildren():
-            existing_pl.append(pl.getId())
-        pl_ids = []
         for pl in screen.plate_refs:
-            pl_id = plate_map[pl.id]
-            if pl_id not in existing_pl:
-                pl_ids.append(pl_id)
-        ezomero.link_plates_to_screen(conn, pl_ids, screen_id)
+            pairs.append((screen_id, plate_map[pl.id]))
+    link_children(pairs, "ScreenPlateLink", conn)
     return
 
 
 def link_images(ome: OME, ds_map: dict, img_map: dict, conn: BlitzGateway):
+    pairs = []
     for ds in ome.datasets:
         ds_id = ds_map[ds.id]
-        img_ids = []
         for img in ds.image_refs:
             try:
-                img_id = img_map[img.id]
-                img_ids.append(img_id)
+                pairs.append((ds_id, img_map[img.id]))
             except KeyError:
                 continue
-        ezomero.link_images_to_dataset(conn, img_ids, ds_id)
+    link_children(pairs, "DatasetImageLink", conn)
+    return
+
+
+def get_existing_links(link_type: str, parent_ids: List[int],
+                       conn: BlitzGateway,
+                       child_ids: Optional[List[int]] = None) -> set:
+    """
+    Return the (parent, child) id pairs of all ``link_type`` links from
+    ``parent_ids``, using one query per batch of parents; with
+    ``child_ids``, only links to those children are returned
+    """
+    existing = set()
+    parent_ids = list(set(parent_ids))
+    q = conn.getQueryService()
+    query = (f"SELECT l.parent.id, l.child.id FROM {link_type} l"
+             " WHERE l.parent.id IN (:ids)")
+    if child_ids is not None:
+        query += " AND l.child.id IN (:cids)"
+    for i in range(0, len(parent_ids), BATCH_SIZE):
+        params = Parameters()
+        params.map = {"ids": rlist([rlong(x) for x in
+                                    parent_ids[i:i + BATCH_SIZE]])}
+        if child_ids is not None:
+            params.map["cids"] = rlist([rlong(x) for x in set(child_ids)])
+        results = q.projection(query, params, conn.SERVICE_OPTS)
+        existing.update((r[0].val, r[1].val) for r in results)
+    return existing
+
+
+def get_existing_pairs(link_type: str, pairs: List[Tuple[int, int]],
+                       conn: BlitzGateway) -> set:
+    """
+    Return which of the (parent, child) id pairs already have a
+    ``link_type`` link
+    """
+    child_ids = list({c for _, c in pairs})
+    if len(child_ids) > BATCH_SIZE:
+        # too many to filter on; fetch every link of the parents instead
+        child_ids = None
+    return get_existing_links(link_type, [p for p, _ in pairs], conn,
+                              child_ids)
+
+
+def link_children(pairs: List[Tuple[int, int]], link_type: str,
+                  conn: BlitzGateway):
+    """
+    Link each (parent, child) pair with a ``link_type`` link, skipping
+    the ones that already exist, and save the new links in batches
+    """
+    parent_class, child_class, link_class = HIERARCHY_LINK_CLASSES[link_type]
+    existing = get_existing_pairs(link_type, pairs, conn)
+    links = []
+    for parent_id, child_id in dict.fromkeys(pairs):
+        if (parent_id, child_id) in existing:
+            continue
+        link = link_class()
+        link.setParent(parent_class(parent_id, False))
+        link.setChild(child_class(child_id, False))
+        links.append(link)
+    save_in_batches(links, conn)
     return
 
 
-def link_annotations(ome: OME, proj_map: dict, ds_map: dict, img_map: dict,
+def link_annotations(ome: OME, ann_index: Dict[str, Annotation],
+                     proj_map: dict, ds_map: dict, img_map: dict,
                      ann_map: dict, scr_map: dict, pl_map: dict,
                      conn: BlitzGateway):
+    links = []
+    well_index = get_well_index([pl_map[pl.id] for pl in ome.plates
+                                 if any(w.annotation_refs for w in pl.wells)],
+                                conn)
     for proj in ome.projects:
         proj_id = proj_map[proj.id]
-        proj_obj = conn.getObject("Project", proj_id)
-        anns = ome.structured_annotations
-        for annref in proj.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(proj_obj, ann, ann_map, conn)
+        links.extend(create_annotation_links("Project", proj_id,
+                                             proj.annotation_refs, ann_index,
+                                             ann_map))
     for ds in ome.datasets:
         ds_id = ds_map[ds.id]
-        ds_obj = conn.getObject("Dataset", ds_id)
-        anns = ome.structured_annotations
-        for annref in ds.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(ds_obj, ann, ann_map, conn)
+        links.extend(create_annotation_links("Dataset", ds_id,
+                                             ds.annotation_refs, ann_index,
+                                             ann_map))
     for img in ome.images:
         try:
             img_id = img_map[img.id]
-            img_obj = conn.getObject("Image", img_id)
-            anns = ome.structured_annotations
-            for annref in img.annotation_refs:
-                ann = next(filter(lambda x: x.id == annref.id, anns))
-                link_one_annotation(img_obj, ann, ann_map, conn)
         except KeyError:
             continue
+        links.extend(create_annotation_links("Image", img_id,
+                                             img.annotation_refs, ann_index,
+                                             ann_map))
     for scr in ome.screens:
         scr_id = scr_map[scr.id]
-        scr_obj = conn.getObject("Screen", scr_id)
-        anns = ome.structured_annotations
-        for annref in scr.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(scr_obj, ann, ann_map, conn)
+        links.extend(create_annotation_links("Screen", scr_id,
+                                             scr.annotation_refs, ann_index,
+                                             ann_map))
     for pl in ome.plates:
         pl_id = pl_map[pl.id]
-        pl_obj = conn.getObject("Plate", pl_id)
-        anns = ome.structured_annotations
-        for annref in pl.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(pl_obj, ann, ann_map, conn)
-        anns = ome.structured_annotations
+        links.extend(create_annotation_links("Plate", pl_id,
+                                             pl.annotation_refs, ann_index,
+                                             ann_map))
         for well in pl.wells:
             if len(well.annotation_refs) > 0:
-                row, col = well.row, well.column
-                well_id = ezomero.get_well_id(conn, pl_id, row, col)
-                well_obj = conn.getObject("Well", well_id)
-                for annref in well.annotation_refs:
-                    ann = next(filter(lambda x: x.id == annref.id, anns))
-                    link_one_annotation(well_obj, ann, ann_map, conn)
+                well_id = well_index.get(pl_id, {}).get((well.row,
+                                                         well.column))
+                if well_id is None:
+                    continue
+                links.extend(create_annotation_links("Well", well_id,
+                                                     well.annotation_refs,
+                                                     ann_index, ann_map))
+    save_annotation_links(links, conn)
     return
 
 
-def link_one_annotation(obj: IObject, ann: Annotation, ann_map: dict,
-                        conn: BlitzGateway):
-    ann_id = ann_map[ann.id]
-    if isinstance(ann, TagAnnotation):
-        ann_obj = conn.getObject("TagAnnotation", ann_id)
-    elif isinstance(ann, MapAnnotation):
-        ann_obj = conn.getObject("MapAnnotation", ann_id)
-    elif isinstance(ann, CommentAnnotation):
-        ann_obj = conn.getObject("CommentAnnotation", ann_id)
-    elif isinstance(ann, LongAnnotation):
-        ann_obj = conn.getObject("LongAnnotation", ann_id)
-    elif isinstance(ann, FileAnnotation):
-        ann_obj = conn.getObject("FileAnnotation", ann_id)
-    elif isinstance(ann, XMLAnnotation):
-        ann_obj = conn.getObject("MapAnnotation", ann_id)
-    else:
-        ann_obj = None
-    if ann_obj:
-        obj.linkAnnotation(ann_obj)
+def save_annotation_links(links: List[IObject], conn: BlitzGateway):
+    """
+    Save new annotation links in batches, skipping the ones that already
+    exist (e.g. saved by an unpack that failed before finishing)
+    """
+    link_types = {link_class: obj_type
+                  for obj_type, (_, link_class) in LINK_CLASSES.items()}
+    by_type = DefaultDict(list)
+    for link in links:
+        by_type[link_types[type(link)]].append(link)
+    new_links = []
+    for obj_type, type_links in by_type.items():
+        pairs = [(link.getParent().getId().val, link.getChild().getId().val)
+                 for link in type_links]
+        existing = get_existing_pairs(f"{obj_type}AnnotationLink", pairs,
+                                      conn)
+        new_links.extend(link for link, pair in zip(type_links, pairs)
+                         if pair not in existing)
+    save_in_batches(new_links, conn)
+    return
+
+
+def get_well_index(plate_ids: List[int], conn: BlitzGateway
+                   ) -> Dict[int, Dict[Tuple[int, int], int]]:
+    """
+    Map each plate id to a ``{(row, column): well id}`` dict of its wells,
+    using one query per batch of plates
+    """
+    well_index: Dict[int, Dict[Tuple[int, int], int]] = {}
+    plate_ids = list(set(plate_ids))
+    q = conn.getQueryService()
+    for i in range(0, len(plate_ids), BATCH_SIZE):
+        params = Parameters()
+        params.map = {"ids": rlist([rlong(x) for x in
+                                    plate_ids[i:i + BATCH_SIZE]])}
+        results = q.projection(
+            "SELECT w.plate.id, w.row, w.column, w.id FROM Well w"
+            " WHERE w.plate.id IN (:ids) ORDER BY w.id",
+            params,
+            conn.SERVICE_OPTS
+            )
+        for r in results:
+            wells = well_index.setdefault(r[0].val, {})
+            wells.setdefault((r[1].val, r[2].val), r[3].val)
+    return well_index
+
+
+def create_annotation_links(obj_type: str, obj_id: int,
+                            annrefs: List[AnnotationRef],
+                            ann_index: Dict[str, Annotation], ann_map: dict
+                            ) -> List[IObject]:
+    parent_class, link_class = LINK_CLASSES[obj_type]
+    links = []
+    for annref in annrefs:
+        ann = ann_index.get(annref.id)
+        if ann is None or ann.id not in ann_map:
+            continue
+        ann_class = None
+        for ome_class, omero_class in ANNOTATION_CLASSES:
+            if isinstance(ann, ome_class):
+                ann_class = omero_class
+                break
+        if ann_class is None:
+            continue
+        link = link_class()
+        link.setParent(parent_class(obj_id, False))
+        link.setChild(ann_class(ann_map[ann.id], False))
+        links.append(link)
+    return links
 
 
 def rename_images(imgs: List[Image], img_map: dict, conn: BlitzGateway):
+    names = {}
     for img in imgs:
         try:
-            img_id = img_map[img.id]
-            im_obj = conn.getObject("Image", img_id)
-            im_obj.setName(img.name)
-            im_obj.save()
+            names[img_map[img.id]] = img.name
         except KeyError:
             print(f"Image corresponding to {img.id} not found. Skipping.")
+    rename_objects("Image", names, conn)
     return
 
 
 def rename_plates(pls: List[Plate], pl_map: dict, conn: BlitzGateway):
+    names = {}
     for pl in pls:
         try:
-            pl_id = pl_map[pl.id]
-            pl_obj = conn.getObject("Plate", pl_id)
-            pl_obj.setName(pl.name)
-            pl_obj.save()
+            names[pl_map[pl.id]] = pl.name
         except KeyError:
             print(f"Plate corresponding to {pl.id} not found. Skipping.")
+    rename_objects("Plate", names, conn)
     return
 
 
+def rename_objects(obj_type: str, names: Dict[int, Optional[str]],
+                   conn: BlitzGateway):
+    """
+    Set the names of existing objects from an ``{id: name}`` dict, loading
+    and saving them in batches and skipping those already named right
+    """
+    ids = [obj_id for obj_id, name in names.items() if name is not None]
+    q = conn.getQueryService()
+    update = conn.getUpdateService()
+    for i in range(0, len(ids), BATCH_SIZE):
+        params = Parameters()
+        params.map = {"ids": rlist([rlong(o)
+                                    for o in ids[i:i + BATCH_SIZE]])}
+        objs = q.findAllByQuery(f"select o from {obj_type} o "
+                                "where o.id in (:ids)",
+                                params, conn.SERVICE_OPTS)
+        changed = []
+        for obj in objs:
+            name = names[obj.getId().val]
+            if obj.getName() is None or obj.getName().val != name:
+                obj.setName(rstring(name))
+                changed.append(obj)
+        if changed:
+            update.saveArray(changed, conn.SERVICE_OPTS)
+    return
+
+
+def populate_images(imgs: List[Image], img_map: dict,
+                    img_datasets: Dict[str, List[int]],
+                    ann_index: Dict[str, Annotation],
+                    roi_index: Dict[str, ROI], ann_map: dict,
+                    conn: BlitzGateway,
+                    journal: Optional[UnpackJournal] = None):
+    """
+    Rename, add ROIs to, and link to their datasets and annotations a set
+    of mapped images, e.g. one fileset as soon as it is imported
+
+    ``img_datasets`` maps source image ids to destination dataset ids.
+    ROIs already recorded in ``journal`` are not created again.
+    """
+    rename_images(imgs, img_map, conn)
+    if journal is None:
+        create_rois(roi_index, imgs, img_map, conn)
+    else:
+        create_rois(roi_index, imgs, img_map, conn,
+                    journal.batches.get("rois"),
+                    partial(journal.record_batch, "rois"))
+    pairs = [(ds_id, img_map[img.id]) for img in imgs
+             for ds_id in img_datasets.get(img.id, [])]
+    link_children(pairs, "DatasetImageLink", conn)
+    links = []
+    for img in imgs:
+        links.extend(create_annotation_links("Image", img_map[img.id],
+                                             img.annotation_refs, ann_index,
+                                             ann_map))
+    save_annotation_links(links, conn)
+    return
+
+
+def run_task_graph(tasks: Dict[str, Task], conn: BlitzGateway,
+                   workers: int = 1, pool: Optional[SessionPool] = None,
+                   done: Optional[Dict[str, Any]] = None,
+                   on_done: Optional[Callable[[str, Any], None]] = None
+                   ) -> Dict[str, Any]:
+    """
+    Run each task as soon as its dependencies are done, at most ``workers``
+    at a time, each on its own gateway from ``pool`` (by default, ``conn``
+    plus sessions joined to it)
+
+    Tasks with a result in ``done`` are not run again. ``on_done`` is
+    called with the name and result of each task as it finishes.
+    """
+    results: Dict[str, Any] = dict(done or {})
+    pending = {name: task for name, task in tasks.items()
+               if name not in results}
+    running = {}
+    if pool is None:
+        pool_context = SessionPool(conn, share_conn=True)
+    else:
+        pool_context = nullcontext(pool)
+    with pool_context as pool, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name, task in list(pending.items()):
+                if all(dep in results for dep in task.deps):
+                    func = partial(lambda t, c: t.func(c, results), task)
+                    running[executor.submit(pool.run, func)] = name
+                    del pending[name]
+            if not running:
+                raise ValueError("Tasks have missing or circular "
+                                 f"dependencies: {list(pending)}")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                results[name] = future.result()
+                if on_done:
+                    on_done(name, results[name])
+    return results
+
+
 def populate_omero(ome: OME, img_map: dict, conn: BlitzGateway, hash: str,
                    folder: str, metadata: List[str], merge: bool,
-                   figure: bool):
-    plate_map, ome = create_plate_map(ome, img_map, conn)
-    rename_images(ome.images, img_map, conn)
-    rename_plates(ome.plates, plate_map, conn)
-    proj_map = create_or_set_projects(ome.projects, conn, merge)
-    ds_map = create_or_set_datasets(ome.datasets, ome.projects, conn, merge)
-    screen_map = create_or_set_screens(ome.screens, conn, merge)
-    ann_map = create_annotations(ome.structured_annotations, conn,
-                                 hash, folder, figure, img_map, metadata)
-    create_rois(ome.rois, ome.images, img_map, conn)
-    link_plates(ome, screen_map, plate_map, conn)
-    link_datasets(ome, proj_map, ds_map, conn)
-    link_images(ome, ds_map, img_map, conn)
-    link_annotations(ome, proj_map, ds_map, img_map, ann_map,
-                     screen_map, plate_map, conn)
+                   figure: bool,
+                   transfer_index: Optional[TransferIndex] = None,
+                   container_maps: Optional[Tuple[dict, dict, dict]] = None,
+                   imported_plates: Optional[Dict[str, List[int]]] = None,
+                   workers: int = 1, ann_map: Optional[dict] = None,
+                   images_done: bool = False,
+                   pool: Optional[SessionPool] = None,
+                   journal: Optional[UnpackJournal] = None):
+    """
+    Create and link everything in ``ome`` around the imported images, as a
+    graph of tasks run on up to ``workers`` sessions from ``pool`` at once
+
+    Only plate renames and plate/annotation links wait for the plate map;
+    annotations skip the plate path XMLAnnotations, so they are created
+    from ``ome`` directly.
+
+    With ``ann_map``, only the annotations missing from it are created.
+    With ``images_done``, images are assumed to be already renamed, given
+    their ROIs and linked (see ``populate_images``).
+
+    Finished tasks, and the annotations and ROIs saved so far, are recorded
+    in ``journal`` and skipped when resuming from it.
+    """
+    ann_index = index_by_id(ome.structured_annotations)
+    roi_index = index_by_id(ome.rois)
+    if transfer_index is None:
+        transfer_index = index_transfer_annotations(
+            ome.structured_annotations, ome.images + ome.plates)
+    if ann_map is None:
+        ann_map = {}
+    done = rois_done = ann_saved = rois_saved = on_done = None
+    if journal is not None:
+        ann_map = {**ann_map, **journal.batches.get("annotations", {})}
+        done = journal.phases
+        rois_done = journal.batches.get("rois")
+        ann_saved = partial(journal.record_batch, "annotations")
+        rois_saved = partial(journal.record_batch, "rois")
+        on_done = journal.record_phase
+    ann_ome = ome.model_copy(update={"images": []}) if images_done else ome
+    tasks = {
+        "plate_map": Task(lambda c, r: match_plates(
+            ome, img_map, transfer_index, c, imported_plates)),
+        "rename_images": Task(lambda c, r: rename_images(
+            ome.images, img_map, c)),
+        "rename_plates": Task(lambda c, r: rename_plates(
+            ome.plates, r["plate_map"], c), ("plate_map",)),
+        "containers": Task(lambda c, r: container_maps or
+                           create_or_set_containers(ome, c, merge)),
+        "annotations": Task(lambda c, r: {**ann_map, **create_annotations(
+            [an for an in ome.structured_annotations if an.id not in ann_map],
+            transfer_index, c, hash, folder, figure, img_map, metadata,
+            ann_saved)}),
+        "rois": Task(lambda c, r: create_rois(
+            roi_index, ome.images, img_map, c, rois_done, rois_saved)),
+        "link_plates": Task(lambda c, r: link_plates(
+            ome, r["containers"][2], r["plate_map"], c),
+            ("containers", "plate_map")),
+        "link_datasets": Task(lambda c, r: link_datasets(
+            ome, r["containers"][0], r["containers"][1], c),
+            ("containers",)),
+        "link_images": Task(lambda c, r: link_images(
+            ome, r["containers"][1], img_map, c), ("containers",)),
+        "link_annotations": Task(lambda c, r: link_annotations(
+            ann_ome, ann_index, r["containers"][0], r["containers"][1],
+            img_map, r["annotations"], r["containers"][2], r["plate_map"], c),
+            ("containers", "annotations", "plate_map")),
+    }
+    if images_done:
+        for name in ("rename_images", "rois", "link_images"):
+            del tasks[name]
+    run_task_graph(tasks, conn, workers, pool, done, on_done)
     return
@@ -28,7 +28,8 @@ from omero.model import DatasetI, ProjectI, ScreenI, PlateI, WellI, Annotation
 from omero.cli import CLI
 from typing import Tuple, List, Optional, Union, Any, Dict, TextIO
 from subprocess import PIPE, DEVNULL
-from generate_omero_objects import get_server_path
+from generate_omero_objects import get_server_path, index_by_id
+from generate_omero_objects import index_transfer_annotations
 import xml.etree.cElementTree as ETree
 from os import PathLike
 import pkg_resources
@@ -863,7 +864,10 @@ def populate_plate(obj: PlateI, ome: OME, conn: BlitzGateway,
 
     # this will need some changing to tackle XMLs
     last_image_anns = ome.images[-1].annotation_refs
-    plate_path = get_server_path(last_image_anns, ome.structured_annotations)
+    ann_index = index_by_id(ome.structured_annotations)
+    transfer_index = index_transfer_annotations(
+        [ann_index[r.id] for r in last_image_anns if r.id in ann_index])
+    plate_path = get_server_path(last_image_anns, transfer_index)
     filepath_anns, refs = create_filepath_annotations(pl.id, conn,
                                                       simple=False,
                                                       plate_path=plate_path)
@@ -968,14 +972,14 @@ def add_annotation(obj: Union[Project, Dataset, Image, Plate, Screen,
 
 def list_file_ids(ome: OME) -> dict:
     id_list = {}
+    transfer_index = index_transfer_annotations(ome.structured_annotations)
     for img in ome.images:
-        path = get_server_path(img.annotation_refs, ome.structured_annotations)
+        path = get_server_path(img.annotation_refs, transfer_index)
         id_list[img.id] = path
     for ann in ome.structured_annotations:
         if isinstance(ann, FileAnnotation):
             if ann.namespace != "omero.web.figure.json":
-                path = get_server_path(ann.annotation_refs,
-                                       ome.structured_annotations)
+                path = get_server_path(ann.annotation_refs, transfer_index)
             id_list[ann.id] = path
     return id_list
 
@@ -0,0 +1,167 @@
+# Copyright (C) 2022 The Jackson Laboratory
+# All rights reserved.
+#
+# Use is subject to license terms supplied in LICENSE.
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Union
+import threading
+import json
+import os
+
+JOURNAL_SUFFIX = "_journal.jsonl"
+JOURNAL_VERSION = 1
+
+
+class UnpackJournal:
+    """
+    Record of what an unpack has done so far, kept next to the extracted
+    folder as ``<folder>_journal.jsonl`` so that a failed unpack can be
+    resumed by running it again; it is removed once the unpack succeeds
+
+    Each step is appended as one JSON line and flushed to disk before the
+    next one starts, so recording stays cheap for big unpacks and a crash
+    loses at most the line being written. Steps are:
+
+    - ``start``: the server, user and group the unpack runs as, and
+      whether it runs with ``--pipeline``; a journal is only resumed by the
+      same ones, the same way
+    - ``import``: the destination Image and Plate ids of an imported file,
+      and the ids of the ROIs the importer created, which are deleted
+    - ``img_map``: source to destination Image ids of some imported files
+    - ``batch``: objects saved by one batch of an unfinished phase, e.g.
+      the ids of new annotations or the ROIs already created
+    - ``processed``: a file whose images were renamed, given their ROIs
+      and linked (``unpack --pipeline``)
+    - ``phase``: a finished ``populate_omero`` task (or the creation of
+      containers) and its result, e.g. the container, plate or annotation
+      id maps
+
+    Steps may be recorded from several threads. Without ``persistent``,
+    they are only kept in memory and no file is read or written.
+    """
+
+    def __init__(self, folder: Union[str, Path], persistent: bool = True):
+        folder = Path(folder)
+        self.path = folder.parent / f"{folder.name}{JOURNAL_SUFFIX}"
+        self.persistent = persistent
+        self.imported: Dict[str, List[int]] = {}
+        self.imported_plates: Dict[str, List[int]] = {}
+        self.imported_rois: Dict[str, List[int]] = {}
+        self.img_map: Dict[str, int] = {}
+        self.mapped: Set[str] = set()
+        self.processed: Set[str] = set()
+        self.phases: Dict[str, Any] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.owner: Optional[Dict[str, Any]] = None
+        self.pipeline: Optional[bool] = None
+        self._lock = threading.Lock()
+        if persistent and self.path.exists():
+            self._replay()
+
+    def _replay(self):
+        end = 0
+        last = b""
+        with open(self.path, 'rb') as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line) if line.strip() else None
+                except json.JSONDecodeError:
+                    # the last line of a crashed unpack may be cut short
+                    print(f"Ignoring incomplete entry in {self.path}")
+                    break
+                end += len(line)
+                last = line
+                if entry is None:
+                    continue
+                if entry.get("version") != JOURNAL_VERSION:
+                    raise ValueError(f"{self.path} was written by an "
+                                     "incompatible version; remove it to "
+                                     "unpack from scratch")
+                self._apply(entry)
+        # drop anything after the last complete entry before appending
+        os.truncate(self.path, end)
+        if last and not last.endswith(b"\n"):
+            with open(self.path, 'ab') as fp:
+                fp.write(b"\n")
+
+    def _apply(self, entry: Dict[str, Any]):
+        step = entry["step"]
+        if step == "start":
+            self.owner = entry["owner"]
+            self.pipeline = entry["pipeline"]
+        elif step == "import":
+            self.imported[entry["path"]] = entry["images"]
+            self.imported_plates[entry["path"]] = entry["plates"]
+            self.imported_rois[entry["path"]] = entry["rois"]
+        elif step == "img_map":
+            self.img_map.update(entry["img_map"])
+            self.mapped.update(entry["paths"])
+        elif step == "processed":
+            self.processed.add(entry["path"])
+        elif step == "batch":
+            self.batches.setdefault(entry["name"], {}).update(entry["items"])
+        elif step == "phase":
+            self.phases[entry["name"]] = entry["result"]
+        else:
+            raise ValueError(f"Unknown step {step} in {self.path}")
+
+    def _append(self, entry: Dict[str, Any]):
+        entry["version"] = JOURNAL_VERSION
+        line = json.dumps(entry)
+        with self._lock:
+            if self.persistent:
+                with open(self.path, 'a') as fp:
+                    fp.write(line + "\n")
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            self._apply(entry)
+        return
+
+    def is_empty(self) -> bool:
+        return not (self.imported or self.phases or self.batches)
+
+    def start(self, host: str, user: str, group: int, pipeline: bool):
+        """
+        Record the server, user, group and mode of a new unpack, or check
+        that a resumed one runs as the same and the same way
+        """
+        owner = {"host": host, "user": user, "group": group}
+        if self.owner == owner and self.pipeline == pipeline:
+            return
+        if not self.is_empty():
+            if self.owner != owner:
+                raise ValueError(f"{self.path} was recorded by another "
+                                 "server, user or group; remove it to "
+                                 "unpack from scratch")
+            mode = "with" if self.pipeline else "without"
+            raise ValueError(f"{self.path} was recorded by an unpack {mode} "
+                             "--pipeline; resume it the same way, or remove "
+                             "it to unpack from scratch")
+        self._append({"step": "start", "owner": owner,
+                      "pipeline": pipeline})
+        return
+
+    def remove(self):
+        if self.persistent:
+            os.remove(self.path)
+        return
+
+    def record_import(self, filepath: str, img_ids: List[int],
+                      plate_ids: List[int], roi_ids: List[int]):
+        self._append({"step": "import", "path": filepath,
+                      "images": img_ids, "plates": plate_ids,
+                      "rois": roi_ids})
+
+    def record_img_map(self, img_map: Dict[str, int], filepaths: List[str]):
+        self._append({"step": "img_map", "img_map": img_map,
+                      "paths": filepaths})
+
+    def record_processed(self, filepath: str):
+        self._append({"step": "processed", "path": filepath})
+
+    def record_batch(self, name: str, items: Dict[str, Any]):
+        self._append({"step": "batch", "name": name, "items": items})
+
+    def record_phase(self, name: str, result: Any):
+        self._append({"step": "phase", "name": name, "result": result})
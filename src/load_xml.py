@@ -0,0 +1,195 @@
+# Copyright (C) 2022 The Jackson Laboratory
+# All rights reserved.
+#
+# Use is subject to license terms supplied in LICENSE.
+
+from ome_types import from_xml
+from ome_types.model import OME
+from pathlib import Path
+from pydantic import TypeAdapter
+from typing import Union, Optional, BinaryIO
+import xml.etree.cElementTree as ETree
+import importlib.util
+import hashlib
+import shutil
+import gzip
+import os
+
+# top-level OME elements that unpack uses; all others are skipped by the
+# fast loader
+UNPACK_ELEMENTS = {"Project", "Dataset", "Screen", "Plate", "Image",
+                   "StructuredAnnotations", "ROI"}
+# transfer.xml as written by pack, optionally compressed
+XML_NAMES = ["transfer.xml", "transfer.xml.gz", "transfer.xml.zst"]
+# binary copy of the transfer.xml model, written next to it by pack
+SIDECAR_NAME = "transfer.msgpack"
+SIDECAR_VERSION = 1
+MD5_BUF_SIZE = 65536
+
+
+def _localname(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _prune_xml(fp: BinaryIO) -> Optional[ETree.Element]:
+    # stream the document, keeping only UNPACK_ELEMENTS under a new root
+    root = None
+    new_root = None
+    depth = 0
+    for event, elem in ETree.iterparse(fp, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if root is None:
+                root = elem
+                new_root = ETree.Element(elem.tag, elem.attrib)
+            continue
+        depth -= 1
+        if _localname(elem.tag) == "Pixels":
+            del elem[:]
+        if depth == 1:
+            if _localname(elem.tag) in UNPACK_ELEMENTS:
+                new_root.append(elem)
+            # kept elements now live in new_root; free the rest
+            root.clear()
+    return new_root
+
+
+def _import_zstandard():
+    if (importlib.util.find_spec('zstandard')):
+        import zstandard
+    else:
+        raise ImportError("Could not import zstandard library. Make sure to "
+                          "install omero-cli-transfer with the optional "
+                          "[zstd] addition")
+    return zstandard
+
+
+def find_transfer_xml(folder: Union[str, Path]) -> Path:
+    """
+    Return the path of the (possibly compressed) transfer.xml in ``folder``
+    """
+    for name in XML_NAMES:
+        if (Path(folder) / name).exists():
+            return Path(folder) / name
+    return Path(folder) / XML_NAMES[0]
+
+
+def open_transfer_xml(path: Union[str, Path]) -> BinaryIO:
+    """
+    Open a transfer.xml for reading, decompressing ``.gz`` and ``.zst``
+    files on the fly
+    """
+    if str(path).endswith(".gz"):
+        return gzip.open(path, 'rb')
+    if str(path).endswith(".zst"):
+        zstandard = _import_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'),
+                                                          closefd=True)
+    return open(path, 'rb')
+
+
+def compress_transfer_xml(path: Union[str, Path], compression: str) -> Path:
+    """
+    Replace the transfer.xml at ``path`` by a ``gz`` or ``zst`` compressed
+    copy and return the new path
+    """
+    new_path = Path(f"{path}.{compression}")
+    with open(path, 'rb') as src:
+        if compression == "gz":
+            with gzip.open(new_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        elif compression == "zst":
+            zstandard = _import_zstandard()
+            with open(new_path, 'wb') as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+        else:
+            raise ValueError(f"Unknown compression {compression}")
+    os.remove(path)
+    return new_path
+
+
+def _file_md5(path: Union[str, Path]) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(MD5_BUF_SIZE)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def write_sidecar(ome: OME, path: Union[str, Path]):
+    """
+    Save ``ome`` as a msgpack sidecar next to the transfer.xml at ``path``,
+    which must already hold the same model
+    """
+    if (importlib.util.find_spec('msgpack')):
+        import msgpack
+    else:
+        raise ImportError("Could not import msgpack library. Make sure to "
+                          "install omero-cli-transfer with the optional "
+                          "[msgpack] addition")
+    data = {"version": SIDECAR_VERSION,
+            "xml_md5": _file_md5(path),
+            "ome": ome.model_dump(mode="json")}
+    with open(Path(path).parent / SIDECAR_NAME, 'wb') as fp:
+        msgpack.pack(data, fp)
+    return
+
+
+def load_sidecar(path: Union[str, Path]) -> Optional[OME]:
+    """
+    Load the msgpack sidecar of the transfer.xml at ``path``, if there is
+    one, msgpack is installed and the sidecar matches the current XML
+
+    Each top-level collection is validated, but the OME object itself is
+    not, so references between objects are not linked (``.ref`` is None).
+    """
+    sidecar = Path(path).parent / SIDECAR_NAME
+    if not sidecar.exists():
+        return None
+    if not importlib.util.find_spec('msgpack'):
+        print(f"Ignoring {sidecar}: msgpack is not installed.")
+        return None
+    import msgpack
+    with open(sidecar, 'rb') as fp:
+        data = msgpack.unpack(fp)
+    if data.get("version") != SIDECAR_VERSION or \
+            data.get("xml_md5") != _file_md5(path):
+        print(f"Ignoring {sidecar}: it does not match {path}.")
+        return None
+    fields = {}
+    for name, value in data["ome"].items():
+        adapter = TypeAdapter(OME.model_fields[name].annotation)
+        fields[name] = adapter.validate_python(value)
+    return OME.model_construct(**fields)
+
+
+def load_transfer_xml(path: Union[str, Path], validate: bool = True) -> OME:
+    """
+    Load a transfer.xml file into an OME object
+
+    A matching sidecar written by pack is used instead of the XML when
+    present (see ``load_sidecar``).
+
+    With ``validate=False`` the file is streamed with iterparse and only
+    the parts unpack needs are kept before building the model, without
+    schema validation: Instruments, Experimenters, Folders and the like
+    are dropped, and each Image keeps its Pixels attributes but not its
+    Channels, Planes or TiffData.
+    """
+    ome = load_sidecar(path)
+    if ome is not None:
+        print(f"Loaded metadata from {Path(path).parent / SIDECAR_NAME}.")
+        return ome
+    if validate:
+        if not str(path).endswith((".gz", ".zst")):
+            return from_xml(path)
+        with open_transfer_xml(path) as fp:
+            return from_xml(fp.read())
+    with open_transfer_xml(path) as fp:
+        new_root = _prune_xml(fp)
+    if new_root is None:
+        raise ValueError(f"{path} is empty")
+    return from_xml(ETree.tostring(new_root), validate=False)
@@ -14,33 +14,45 @@ from pathlib import Path
 import sys
 import os
 import copy
-from functools import wraps
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 from typing import DefaultDict
 import hashlib
+import tempfile
+import yaml
+import time
 from zipfile import ZipFile
 from typing import Callable, List, Any, Dict, Union, Optional, Tuple
-import xml.etree.cElementTree as ETree
 
 from generate_xml import populate_xml, populate_tsv, populate_rocrate
 from generate_xml import populate_xml_folder
 from generate_omero_objects import populate_omero, get_server_path
-
-import ezomero
-from ome_types.model import XMLAnnotation, OME
-from ome_types import from_xml, to_xml
+from generate_omero_objects import create_or_set_containers
+from generate_omero_objects import index_transfer_annotations
+from generate_omero_objects import TransferIndex
+from generate_omero_objects import get_transferred_ids, BATCH_SIZE
+from generate_omero_objects import create_annotations, index_by_id
+from generate_omero_objects import populate_images
+from session_pool import SessionPool
+from journal import UnpackJournal
+from load_xml import load_transfer_xml, write_sidecar, SIDECAR_NAME
+from load_xml import find_transfer_xml, compress_transfer_xml
+
+from ome_types.model import OME
+from ome_types import to_xml
 from omero.sys import Parameters
-from omero.rtypes import rstring
+from omero.rtypes import rstring, rlist, rlong
 from omero.cli import CLI, GraphControl, GraphArg
 from omero.cli import NonZeroReturnCode
 from omero.gateway import BlitzGateway
+from omero.cmd import ERR
 from omero.grid import ManagedRepositoryPrx as MRepo
 
 
 DIR_PERM = 0o755
 MD5_BUF_SIZE = 65536
-
-
+POLL_INTERVAL = 0.5
 HELP = ("""Transfer objects and annotations between servers.
 
 Both subcommands (pack and unpack) will use an existing OMERO session
@@ -86,6 +98,14 @@ guaranteed to work with unpack.
 orig_group`), other options are `none`, `img_id`, `timestamp`, `software`,
 `version`, `md5`, `hostname`, `db_id`, `orig_user`, `orig_group`.
 
+--sidecar also saves the metadata as `transfer.msgpack` next to
+`transfer.xml`; unpack loads it much faster than the XML whenever it still
+matches `transfer.xml`. Requires the optional [msgpack] dependency.
+
+--compress_xml writes `transfer.xml.gz` or `transfer.xml.zst` instead of
+`transfer.xml`, which unpack reads transparently. `zst` requires the optional
+[zstd] dependency.
+
 --binaries allows to specify whether to archive binary data
 (e.g images, ROIs, FileAnnotations) or only create the transfer.xml.
 Default is `all` and will create the archive.
@@ -105,9 +125,10 @@ omero transfer pack --binaries all Dataset:1111 /home/user/new_folder/pack.tar
 
 UNPACK_HELP = ("""Unpacks a transfer packet into an OMERO hierarchy.
 
-Unpacks an existing transfer packet, imports images
-as orphans and uses the XML contained in the transfer packet to re-create
-links, annotations and ROIs.
+Unpacks an existing transfer packet, creates the Projects, Datasets and
+Screens it contains, imports images directly into their Datasets (and plates
+into their Screens) and uses the XML contained in the transfer packet to
+re-create the remaining links, annotations and ROIs.
 
 --ln_s forces imports to use the transfer=ln_s option, in-place importing
 files. Same restrictions of regular in-place imports apply.
@@ -118,6 +139,23 @@ will be unzipped.
 --folder allows the user to point to a previously-unpacked folder rather than
 a single file.
 
+Progress is recorded in a `<folder>_journal.jsonl` file next to the unpacked
+folder, which is removed once the unpack succeeds. Running a failed unpack
+again (on the same server, as the same user and group, and with or without
+--pipeline as before) resumes it from there, without re-importing files or
+re-creating containers, annotations, ROIs and links. Remove the journal to
+unpack from scratch. If the journal cannot be written there, the unpack runs
+without one.
+
+A compressed `transfer.xml.gz` or `transfer.xml.zst` (see `pack
+--compress_xml`) is read transparently in place of `transfer.xml`.
+
+--fast_xml streams `transfer.xml` instead of validating it against the OME
+schema, and only reads the parts that unpack uses (pixel-level metadata such
+as channels and planes is skipped). Use it for very large metadata files.
+Either way, a `transfer.msgpack` sidecar written by `pack --sidecar` is loaded
+instead of `transfer.xml` as long as it still matches it.
+
 --merge will use existing Projects, Datasets and Screens if the current user
 already owns entities with the same name as ones defined in `transfer.xml`,
 effectively merging the "new" unpacked entities with existing ones.
@@ -127,6 +165,17 @@ there's no guaranteed behavior for images referenced on Figures that were not
 included in a pack. You can just have an image missing, a completely unrelated
 image, a permission error. Use at your own risk!
 
+--workers runs the creation and linking of annotations, ROIs, plates and
+links after import on up to that many parallel sessions (the current one, and
+others joined to it), starting each step as soon as the steps it depends on
+are done. Default is 1, which only uses the current session.
+
+--pipeline renames, adds ROIs to and links the images of each imported file
+while the next files are still importing, on `--workers` sessions of their
+own, instead of waiting for all imports to finish. Only plates, figures and
+the links and annotations of Projects, Datasets and Screens are left for after
+the last import.
+
 --metadata allows you to specify which transfer metadata will be used from
 `transfer.xml` as MapAnnotation values to the images. Fields that do not
 exist on `transfer.xml` will be ignored. Default is `all` (equivalent to
@@ -172,19 +221,25 @@ omero transfer prepare --filelist /home/user/file_with_paths.txt
 def gateway_required(func: Callable) -> Callable:
     """
     Decorator which initializes a client (self.client),
-    a BlitzGateway (self.gateway), and makes sure that
-    all services of the Blitzgateway are closed again.
+    a BlitzGateway (self.gateway), a pool of gateways for
+    parallel workers (self.pool), handing out self.gateway
+    first and then gateways joined to its session, and makes
+    sure that all services of the Blitzgateways are closed again.
     """
     @wraps(func)
     def _wrapper(self, *args, **kwargs):
         self.client = self.ctx.conn(*args)
         self.session = self.client.getSessionId()
         self.gateway = BlitzGateway(client_obj=self.client)
+        self.pool = SessionPool(self.gateway, share_conn=True)
         router = self.client.getRouter(self.client.getCommunicator())
         self.hostname = str(router).split('-h ')[-1].split()[0]
         try:
             return func(self, *args, **kwargs)
         finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
             if self.gateway is not None:
                 self.gateway.close(hard=False)
                 self.gateway = None
@@ -248,6 +303,13 @@ class TransferControl(GraphControl):
                      'orig_user', 'orig_group'], nargs='+',
             help="Metadata field to be added to MapAnnotation"
         )
+        pack.add_argument(
+                "--sidecar", help="Also save the metadata as "
+                                  f"{SIDECAR_NAME} for faster unpacking",
+                action="store_true")
+        pack.add_argument(
+                "--compress_xml", choices=["gz", "zst"],
+                help="Compress transfer.xml with gzip or zstandard")
         pack.add_argument(
                 "--plugin", help="Use external plugin for packing.",
                 type=str)
@@ -280,6 +342,18 @@ class TransferControl(GraphControl):
             "--output", type=str, help="Output directory where zip "
                                        "file will be extracted"
         )
+        unpack.add_argument(
+            "--workers", type=int, default=1,
+            help="Number of OMERO sessions used in parallel to create and "
+                 "link objects after import (default: 1)")
+        unpack.add_argument(
+                "--pipeline", help="Process the images of each file as soon "
+                                   "as it is imported",
+                action="store_true")
+        unpack.add_argument(
+                "--fast_xml", help="Load transfer.xml without validation, "
+                                   "keeping only what unpack uses",
+                action="store_true")
         unpack.add_argument(
             "--skip", choices=['all', 'checksum', 'thumbnails', 'minmax',
                                'upgrade'],
@@ -487,6 +561,11 @@ class TransferControl(GraphControl):
                 raise ValueError("Single plate or screen cannot be "
                                  "packaged in human-readable format")
 
+        if (args.sidecar or args.compress_xml) and \
+                (args.barchive or args.rocrate):
+            raise ValueError("The `--sidecar` and `--compress_xml` options "
+                             "need a transfer.xml, which Bioimage Archive "
+                             "and RO-Crate packages do not have")
         if (args.binaries == "none") and args.simple:
             raise ValueError("The `--binaries none` and `--simple` options "
                              "are  incompatible")
@@ -542,7 +621,13 @@ class TransferControl(GraphControl):
                              self.gateway)
 
         if args.simple:
-            self._fix_pixels_image_simple(ome, folder, md_fp)
+            ome = self._fix_pixels_image_simple(ome, folder, md_fp)
+        if args.compress_xml:
+            md_fp = str(compress_transfer_xml(md_fp, args.compress_xml))
+            print(f"Compressed metadata to {md_fp}.")
+        if args.sidecar:
+            print(f"Saving metadata sidecar next to {md_fp}.")
+            write_sidecar(ome, md_fp)
         if args.barchive:
             print(f"Creating Bioimage Archive TSV at {md_fp}.")
             populate_tsv(src_datatype, ome, md_fp,
@@ -590,33 +675,119 @@ class TransferControl(GraphControl):
     def __unpack(self, args):
         self.metadata = []
         self._process_metadata(args.metadata)
+        if args.workers < 1:
+            raise ValueError("--workers must be at least 1")
         if not args.folder:
             print(f"Unzipping {args.filepath}...")
             hash, ome, folder = self._load_from_pack(args.filepath,
-                                                     args.output)
+                                                     args.output,
+                                                     args.fast_xml)
         else:
             folder = Path(args.filepath)
-            ome = from_xml(folder / "transfer.xml")
+            ome = load_transfer_xml(find_transfer_xml(folder),
+                                    validate=not args.fast_xml)
             hash = "imported from folder"
         print("Generating Image mapping and import filelist...")
-        ome, src_img_map, filelist = self._create_image_map(ome)
-        print("Importing data as orphans...")
+        transfer_index = index_transfer_annotations(
+            ome.structured_annotations, ome.images + ome.plates)
+        ome, src_img_map, filelist = self._create_image_map(ome,
+                                                            transfer_index)
+        journal = UnpackJournal(folder)
+        if not os.access(journal.path.parent, os.W_OK):
+            print(f"Cannot write {journal.path}, so this unpack cannot be "
+                  "resumed if it fails.")
+            journal = UnpackJournal(folder, persistent=False)
+        resumed = not journal.is_empty()
+        ec = self.gateway.getEventContext()
+        journal.start(self.hostname, ec.userName, ec.groupId, args.pipeline)
+        if resumed:
+            print(f"Resuming the unpack recorded in {journal.path} (remove "
+                  "it to unpack from scratch)...")
+            self._resume_journal(journal)
+        container_maps = journal.phases.get("containers")
+        if container_maps is None:
+            print("Creating Projects, Datasets and Screens...")
+            container_maps = create_or_set_containers(ome, self.gateway,
+                                                      args.merge)
+            journal.record_phase("containers", container_maps)
+        _, ds_map, screen_map = container_maps
+        targets = self._get_import_targets(ome, src_img_map, ds_map,
+                                           screen_map, transfer_index)
+        print("Importing data...")
         if args.ln_s_import:
             ln_s = True
         else:
             ln_s = False
-        dest_img_map = self._import_files(folder, filelist,
-                                          ln_s, args.skip, self.gateway)
-        self._delete_all_rois(dest_img_map, self.gateway)
-        print("Matching source and destination images...")
-        img_map = self._make_image_map(src_img_map, dest_img_map, self.gateway)
+        imported_plates = dict(journal.imported_plates)
+        filelist = [f for f in filelist if f not in journal.imported]
+        if args.pipeline:
+            img_map, ann_map = self._import_pipelined(
+                ome, folder, filelist, ln_s, args.skip, targets,
+                imported_plates, src_img_map, ds_map, transfer_index, hash,
+                args.workers, journal)
+        else:
+            def on_import(filepath: str, dest_path: str, img_ids: List[int],
+                          roi_ids: List[int]):
+                journal.record_import(filepath, img_ids,
+                                      imported_plates.get(filepath, []),
+                                      roi_ids)
+
+            self._import_files(folder, filelist, ln_s, args.skip,
+                               self.gateway, targets, imported_plates,
+                               on_import)
+            print("Matching source and destination images...")
+            unmapped = [f for f in journal.imported if f not in journal.mapped]
+            if unmapped:
+                dest_img_map = {os.path.join(str(folder), '.', f):
+                                journal.imported[f] for f in unmapped}
+                # the importer reports new images only, and the fallback
+                # query already leaves out transferred ones
+                journal.record_img_map(
+                    self._make_image_map(src_img_map, dest_img_map),
+                    unmapped)
+            img_map = dict(journal.img_map)
+            ann_map = None
         print("Creating and linking OMERO objects...")
         populate_omero(ome, img_map, self.gateway,
-                       hash, folder, self.metadata, args.merge, args.figure)
+                       hash, folder, self.metadata, args.merge, args.figure,
+                       transfer_index, container_maps, imported_plates,
+                       args.workers, ann_map, images_done=args.pipeline,
+                       pool=self.pool, journal=journal)
+        journal.remove()
         return
 
-    def _load_from_pack(self, filepath: str, output: Optional[str] = None
-                        ) -> Tuple[str, OME, Path]:
+    def _resume_journal(self, journal: UnpackJournal):
+        """Check that the containers recorded in ``journal`` still exist,
+        and delete the importer ROIs whose deletion was interrupted.
+        """
+        container_maps = journal.phases.get("containers")
+        if container_maps:
+            q = self.gateway.getQueryService()
+            for obj_type, obj_map in zip(["Project", "Dataset", "Screen"],
+                                         container_maps):
+                ids = list(set(obj_map.values()))
+                for i in range(0, len(ids), BATCH_SIZE):
+                    params = Parameters()
+                    params.map = {"ids": rlist([rlong(x) for x in
+                                                ids[i:i + BATCH_SIZE]])}
+                    found = q.projection(
+                        f"SELECT o.id FROM {obj_type} o WHERE o.id IN (:ids)",
+                        params,
+                        self.gateway.SERVICE_OPTS
+                        )
+                    if len(found) < len(ids[i:i + BATCH_SIZE]):
+                        raise ValueError(f"{obj_type}s recorded in "
+                                         f"{journal.path} no longer exist; "
+                                         "remove it to unpack from scratch")
+        roi_ids = [r for ids in journal.imported_rois.values() for r in ids]
+        roi_ids = self._get_roi_ids(roi_ids, self.gateway, "id")
+        if roi_ids:
+            print(f"Deleting {len(roi_ids)} ROIs left by the importer...")
+            self._wait_on_handles(self._delete_rois(roi_ids, self.gateway))
+        return
+
+    def _load_from_pack(self, filepath: str, output: Optional[str] = None,
+                        fast_xml: bool = False) -> Tuple[str, OME, Path]:
         if (not filepath) or (not isinstance(filepath, str)):
             raise TypeError("filepath must be a string")
         if output and not isinstance(output, str):
@@ -645,50 +816,123 @@ class TransferControl(GraphControl):
                 raise ValueError("File is not a zip or tar file")
         else:
             raise FileNotFoundError("filepath is not a zip file")
-        ome = from_xml(folder / "transfer.xml")
+        ome = load_transfer_xml(find_transfer_xml(folder),
+                                validate=not fast_xml)
         return hash, ome, folder
 
-    def _create_image_map(self, ome: OME
+    def _create_image_map(self, ome: OME,
+                          transfer_index: Optional[TransferIndex] = None
                           ) -> Tuple[OME, DefaultDict, List[str]]:
         if not (isinstance(ome, OME)):
             raise TypeError("XML is not valid OME format")
+        if transfer_index is None:
+            transfer_index = index_transfer_annotations(
+                ome.structured_annotations, ome.images + ome.plates)
         img_map = DefaultDict(list)
         filelist = []
         newome = copy.deepcopy(ome)
-        map_ref_ids = []
+        map_ref_ids = set()
         for img in ome.images:
-            fpath = get_server_path(img.annotation_refs,
-                                    ome.structured_annotations)
+            fpath = get_server_path(img.annotation_refs, transfer_index)
             img_map[fpath].append(int(img.id.split(":")[-1]))
             # use XML path annotation instead
             if fpath.endswith('mock_folder'):
                 filelist.append(fpath.rstrip("mock_folder"))
             else:
                 filelist.append(fpath)
-            for anref in img.annotation_refs:
-                for an in newome.structured_annotations:
-                    if anref.id == an.id and isinstance(an, XMLAnnotation):
-                        tree = ETree.fromstring(to_xml(an.value,
-                                                       canonicalize=True))
-                        for el in tree:
-                            if el.tag.rpartition('}')[2] == \
-                                    "CLITransferServerPath":
-                                newome.structured_annotations.remove(an)
-                                map_ref_ids.append(an.id)
+            for transfer_xml in transfer_index.by_owner.get(img.id, []):
+                if transfer_xml.server_path is not None:
+                    map_ref_ids.add(transfer_xml.id)
+        xml_anns = newome.structured_annotations.xml_annotations
+        xml_anns[:] = [a for a in xml_anns if a.id not in map_ref_ids]
         for i in newome.images:
-            for ref in i.annotation_refs:
-                if ref.id in map_ref_ids:
-                    i.annotation_refs.remove(ref)
+            i.annotation_refs[:] = [r for r in i.annotation_refs
+                                    if r.id not in map_ref_ids]
         filelist = list(set(filelist))
         img_map = DefaultDict(list, {x: sorted(img_map[x])
                               for x in img_map.keys()})
         return newome, img_map, filelist
 
+    def _get_import_targets(self, ome: OME, src_img_map: dict, ds_map: dict,
+                            screen_map: dict, transfer_index: TransferIndex
+                            ) -> Dict[str, str]:
+        """Find the destination container to import each file into.
+
+        Files go into a Dataset only when all their images belong to that
+        Dataset and no other, and plate files into the Screen of their
+        plate. Other files are imported as orphans, and all remaining
+        links are created after import.
+
+        Returns
+        -------
+        targets : dict
+            ``Dataset:<id>`` or ``Screen:<id>`` per entry of the import
+            filelist.
+        """
+        targets = {}
+        img_datasets = DefaultDict(set)
+        for ds in ome.datasets:
+            for imgref in ds.image_refs:
+                img_datasets[imgref.id].add(ds_map[ds.id])
+        file_datasets = DefaultDict(list)
+        for fpath, img_ids in src_img_map.items():
+            if fpath.endswith('mock_folder'):
+                fpath = fpath.rstrip("mock_folder")
+            for img_id in img_ids:
+                file_datasets[fpath].append(
+                    frozenset(img_datasets.get(f"Image:{img_id}", ())))
+        for fpath, datasets in file_datasets.items():
+            # a file is imported whole, so only target a Dataset that
+            # every one of its images is in, alone
+            if len(set(datasets)) == 1 and len(datasets[0]) == 1:
+                ds_id, = datasets[0]
+                targets[fpath] = f"Dataset:{ds_id}"
+        plate_screens = {}
+        for scr in ome.screens:
+            for plref in scr.plate_refs:
+                plate_screens.setdefault(plref.id, screen_map[scr.id])
+        filepaths = {f.strip('/'): f for f in src_img_map.keys()}
+        for plate in ome.plates:
+            if plate.id not in plate_screens:
+                continue
+            plate_path = get_server_path(plate.annotation_refs,
+                                         transfer_index)
+            if not plate_path or plate_path.startswith("pixel_images"):
+                # plates exported as loose images are rebuilt after import
+                continue
+            plate_path = plate_path.strip('/')
+            if plate_path in filepaths:
+                fpath = filepaths[plate_path]
+                if fpath.endswith('mock_folder'):
+                    fpath = fpath.rstrip("mock_folder")
+                targets[fpath] = f"Screen:{plate_screens[plate.id]}"
+        return targets
+
     def _import_files(self, folder: Path, filelist: List[str], ln_s: bool,
-                      skip: str, gateway: BlitzGateway) -> dict:
+                      skip: str, gateway: BlitzGateway,
+                      targets: Optional[Dict[str, str]] = None,
+                      imported_plates: Optional[Dict[str, List[int]]] = None,
+                      on_import: Optional[Callable[[str, str, List[int],
+                                                    List[int]], None]] = None
+                      ) -> dict:
+        """Import each file of ``filelist`` from ``folder``.
+
+        ``targets`` optionally gives the ``Dataset:<id>`` or ``Screen:<id>``
+        to import each file into. If ``imported_plates`` is given, it is
+        filled with the Plate ids reported for each file. ``on_import`` is
+        called with the filelist entry, absolute path, Image ids and the
+        ids of the ROIs the importer created of each file right after it is
+        imported, before those ROIs are deleted.
+
+        Returns
+        -------
+        dest_map : dict
+            Imported Image ids per absolute path of the imported file.
+        """
         cli = CLI()
         cli.loadplugins()
         dest_map = {}
+        roi_deletions = []
         curr_folder = str(Path('.').resolve())
         for filepath in filelist:
             dest_path = str(os.path.join(curr_folder, folder,  '.', filepath))
@@ -697,18 +941,229 @@ class TransferControl(GraphControl):
                 command.append('--transfer=ln_s')
             if skip:
                 command.extend(['--skip', skip])
-            cli.invoke(command)
-            img_ids = self._get_image_ids(dest_path, gateway)
+            if targets and filepath in targets:
+                target_type, target_id = targets[filepath].split(":")
+                if target_type == "Screen":
+                    command.extend(['-r', target_id])
+                else:
+                    command.extend(['-d', target_id])
+            fd, output_path = tempfile.mkstemp(suffix=".yml")
+            os.close(fd)
+            command.extend(['--output', 'yaml', '--file', output_path])
+            try:
+                cli.invoke(command)
+                imported = self._parse_import_output(output_path)
+            finally:
+                os.remove(output_path)
+            img_ids = sorted(set(imported['Image']))
+            if not img_ids:
+                # importer did not report anything; fall back to querying
+                img_ids = self._get_image_ids(dest_path, gateway)
             dest_map[dest_path] = img_ids
+            if imported_plates is not None:
+                imported_plates[filepath] = sorted(set(imported['Plate']))
+            # ROIs come from transfer.xml, so the ones the importer created
+            # from the file go away while the next files are imported
+            roi_ids = self._get_roi_ids(img_ids, gateway)
+            if on_import:
+                on_import(filepath, dest_path, img_ids, roi_ids)
+            roi_deletions.extend(self._delete_rois(roi_ids, gateway))
+        self._wait_on_handles(roi_deletions)
         return dest_map
 
-    def _delete_all_rois(self, dest_map: dict, gateway: BlitzGateway):
-        roi_service = gateway.getRoiService()
-        for imgs in dest_map.values():
-            for img in imgs:
-                result = roi_service.findByImage(img, None)
-                for roi in result.rois:
-                    gateway.deleteObject(roi)
+    def _import_pipelined(self, ome: OME, folder: Path, filelist: List[str],
+                          ln_s: bool, skip: str, targets: Dict[str, str],
+                          imported_plates: Dict[str, List[int]],
+                          src_img_map: dict, ds_map: dict,
+                          transfer_index: TransferIndex, hash: str,
+                          workers: int, journal: UnpackJournal
+                          ) -> Tuple[dict, dict]:
+        """Import each file of ``filelist`` and process its images while
+        the next files are imported.
+
+        Annotations (except figures) are created first, so that as soon as
+        a file is imported its images can be mapped, renamed, given their
+        ROIs and linked to their datasets and annotations, on up to
+        ``workers`` sessions joined to ``self.gateway``, which keeps
+        importing. Files that ``journal`` shows were imported but not
+        processed by an earlier run are processed first.
+
+        Returns
+        -------
+        img_map : dict
+            Destination Image id per source Image id.
+        ann_map : dict
+            Destination annotation id per source annotation id.
+        """
+        ann_map = journal.phases.get("image_annotations")
+        if ann_map is None:
+            print("Creating annotations...")
+            ann_map = dict(journal.batches.get("image_annotations", {}))
+            ann_map.update(create_annotations(
+                [an for an in ome.structured_annotations
+                 if an.id not in ann_map],
+                transfer_index, self.gateway, hash, folder, False, {},
+                self.metadata,
+                partial(journal.record_batch, "image_annotations")))
+            journal.record_phase("image_annotations", ann_map)
+        ann_index = index_by_id(ome.structured_annotations)
+        roi_index = index_by_id(ome.rois)
+        img_index = index_by_id(ome.images)
+        img_datasets = DefaultDict(list)
+        for ds in ome.datasets:
+            for imgref in ds.image_refs:
+                img_datasets[imgref.id].append(ds_map[ds.id])
+        src_by_file = DefaultDict(dict)
+        for k, v in src_img_map.items():
+            if k.endswith("mock_folder"):
+                src_by_file[k.rstrip("mock_folder")][k] = v
+            else:
+                src_by_file[k][k] = v
+        futures = []
+
+        def map_file(filepath: str, img_ids: List[int]):
+            dest_path = os.path.join(str(folder), '.', filepath)
+            file_map = self._make_image_map(src_by_file[filepath],
+                                            {dest_path: img_ids})
+            for src_ids in src_by_file[filepath].values():
+                for img_id in src_ids:
+                    if f"Image:{img_id}" not in file_map:
+                        print(f"Image corresponding to Image:{img_id} "
+                              "not found. Skipping.")
+            journal.record_img_map(file_map, [filepath])
+
+        def process_file(filepath: str, file_map: dict,
+                         gateway: BlitzGateway):
+            imgs = [img_index[k] for k in file_map]
+            populate_images(imgs, file_map, img_datasets, ann_index,
+                            roi_index, ann_map, gateway, journal)
+            journal.record_processed(filepath)
+
+        # the current session keeps importing, so workers get their own
+        with SessionPool(self.gateway) as pool, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+
+            def submit(filepath: str):
+                file_map = {}
+                for src_ids in src_by_file[filepath].values():
+                    for img_id in src_ids:
+                        key = f"Image:{img_id}"
+                        if key in journal.img_map:
+                            file_map[key] = journal.img_map[key]
+                futures.append(executor.submit(
+                    pool.run,
+                    partial(process_file, filepath, file_map)))
+
+            def check_processed():
+                # stop importing as soon as processing a file fails
+                for future in [f for f in futures if f.done()]:
+                    futures.remove(future)
+                    if future.exception() is not None:
+                        for pending in futures:
+                            pending.cancel()
+                        raise future.exception()
+
+            def on_import(filepath: str, dest_path: str, img_ids: List[int],
+                          roi_ids: List[int]):
+                journal.record_import(filepath, img_ids,
+                                      imported_plates.get(filepath, []),
+                                      roi_ids)
+                map_file(filepath, img_ids)
+                submit(filepath)
+                check_processed()
+
+            for filepath, img_ids in list(journal.imported.items()):
+                if filepath not in journal.mapped:
+                    map_file(filepath, img_ids)
+                if filepath not in journal.processed:
+                    submit(filepath)
+            self._import_files(folder, filelist, ln_s, skip, self.gateway,
+                               targets, imported_plates, on_import)
+            for future in futures:
+                future.result()
+        return dict(journal.img_map), ann_map
+
+    def _parse_import_output(self, output_path: str) -> Dict[str, List[int]]:
+        """Parse the YAML written by ``omero import --output yaml``.
+
+        Returns
+        -------
+        imported : dict
+            Lists of ``Fileset``, ``Image`` and ``Plate`` ids reported
+            by the importer.
+        """
+        imported: Dict[str, List[int]] = {"Fileset": [], "Image": [],
+                                          "Plate": []}
+        if not os.path.exists(output_path):
+            return imported
+        with open(output_path, 'r') as fp:
+            entries = yaml.safe_load(fp) or []
+        for entry in entries:
+            for key, ids in imported.items():
+                value = entry.get(key)
+                if value is None:
+                    continue
+                if not isinstance(value, list):
+                    value = [value]
+                ids.extend(int(i) for i in value)
+        return imported
+
+    def _get_roi_ids(self, img_ids: List[int], gateway: BlitzGateway,
+                     field: str = "image.id") -> List[int]:
+        """Get the Ids of all ROIs on the given images, or with
+        ``field="id"`` those of the given ROI ids that still exist.
+        """
+        q = gateway.getQueryService()
+        roi_ids = []
+        for i in range(0, len(img_ids), BATCH_SIZE):
+            params = Parameters()
+            params.map = {"ids": rlist([rlong(x) for x in
+                                        img_ids[i:i + BATCH_SIZE]])}
+            results = q.projection(
+                f"SELECT r.id FROM Roi r WHERE r.{field} IN (:ids)",
+                params,
+                gateway.SERVICE_OPTS
+                )
+            roi_ids.extend(r[0].val for r in results)
+        return roi_ids
+
+    def _delete_rois(self, roi_ids: List[int], gateway: BlitzGateway
+                     ) -> list:
+        """Submit deletion of the given ROIs.
+
+        Returns
+        -------
+        handles : list of ``omero.cmd.HandlePrx``
+            One handle per batch of ROIs; wait on them with
+            ``_wait_on_handles``.
+        """
+        handles = []
+        for i in range(0, len(roi_ids), BATCH_SIZE):
+            handles.append(gateway.deleteObjects(
+                "Roi", roi_ids[i:i + BATCH_SIZE], wait=False))
+        return handles
+
+    def _wait_on_handles(self, handles: list):
+        # poll all submitted requests together
+        errors = []
+        try:
+            while handles:
+                time.sleep(POLL_INTERVAL)
+                pending = []
+                for handle in handles:
+                    rsp = handle.getResponse()
+                    if rsp is None:
+                        pending.append(handle)
+                        continue
+                    if isinstance(rsp, ERR):
+                        errors.append(rsp)
+                    handle.close()
+                handles = pending
+        finally:
+            for handle in handles:
+                handle.close()
+        if errors:
+            raise ValueError(f"Could not delete imported ROIs: {errors[0]}")
         return
 
     def _get_image_ids(self, file_path: str, conn: BlitzGateway) -> List[str]:
@@ -733,21 +1188,9 @@ class TransferControl(GraphControl):
             params,
             conn.SERVICE_OPTS
             )
-        all_image_ids = list(set(sorted([r[0].val for r in results])))
-        image_ids = []
-        for img_id in all_image_ids:
-            anns = ezomero.get_map_annotation_ids(conn, "Image", img_id)
-            if not anns:
-                image_ids.append(img_id)
-            else:
-                is_annotated = False
-                for ann in anns:
-                    ann_content = conn.getObject("MapAnnotation", ann)
-                    if ann_content.getNs() == \
-                            'openmicroscopy.org/cli/transfer':
-                        is_annotated = True
-                if not is_annotated:
-                    image_ids.append(img_id)
+        all_image_ids = sorted(set([r[0].val for r in results]))
+        transferred = get_transferred_ids(conn, "Image", all_image_ids)
+        image_ids = [i for i in all_image_ids if i not in transferred]
         return image_ids
 
     def _make_image_map(self, source_map: dict, dest_map: dict,
@@ -770,24 +1213,16 @@ class TransferControl(GraphControl):
                                       for x in src_dict.keys()})
         dest_dict = DefaultDict(list, {x: sorted(dest_dict[x])
                                        for x in dest_dict.keys()})
+        transferred = set()
+        if conn:
+            candidates = [i for k in src_dict.keys() if k in dest_dict
+                          for i in dest_dict[k]]
+            transferred = get_transferred_ids(conn, "Image", candidates)
         for src_k in src_dict.keys():
             src_v = src_dict[src_k]
             if src_k in dest_dict.keys():
                 dest_v = dest_dict[src_k]
-                clean_dest = []
-                if not conn:
-                    clean_dest = dest_v
-                else:
-                    for i in dest_v:
-                        img_obj = conn.getObject("Image", i)
-                        anns = 0
-                        for j in img_obj.listAnnotations():
-                            ns = j.getNs()
-                            if ns.startswith(
-                                    "openmicroscopy.org/cli/transfer"):
-                                anns += 1
-                        if not anns:
-                            clean_dest.append(i)
+                clean_dest = [i for i in dest_v if i not in transferred]
                 if len(src_v) == len(clean_dest):
                     for count in range(len(src_v)):
                         map_key = f"Image:{src_v[count]}"
@@ -0,0 +1,105 @@
+# Copyright (C) 2022 The Jackson Laboratory
+# All rights reserved.
+#
+# Use is subject to license terms supplied in LICENSE.
+
+from omero.gateway import BlitzGateway
+from typing import Any, Callable, Iterator, List
+from contextlib import contextmanager
+import threading
+
+# seconds between the keep-alive pings of each joined session
+KEEPALIVE_INTERVAL = 300
+
+
+class SessionPool:
+    """
+    Gateways joined to the session of ``conn``, handed out to workers
+
+    Joined gateways are created on demand and reused once released, so the
+    pool grows to the number of workers using it at the same time. They
+    share the session, and so the permissions, of ``conn``, and are always
+    handed out in the group ``conn`` is currently in. With ``share_conn``,
+    ``conn`` itself is handed out first, so a single worker never needs a
+    joined session.
+    """
+
+    def __init__(self, conn: BlitzGateway, share_conn: bool = False,
+                 keepalive: int = KEEPALIVE_INTERVAL):
+        self.conn = conn
+        self.keepalive = keepalive
+        self._lock = threading.Lock()
+        self._idle: List[BlitzGateway] = [conn] if share_conn else []
+        self._joined: List[BlitzGateway] = []
+
+    def __enter__(self) -> "SessionPool":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _join(self) -> BlitzGateway:
+        client = self.conn.c.createClient(secure=True)
+        client.enableKeepAlive(self.keepalive)
+        gateway = BlitzGateway(client_obj=client)
+        with self._lock:
+            self._joined.append(gateway)
+        return gateway
+
+    def _discard(self, gateway: BlitzGateway):
+        with self._lock:
+            self._joined.remove(gateway)
+        try:
+            gateway.close(hard=False)
+        except Exception:
+            pass
+
+    def acquire(self) -> BlitzGateway:
+        """
+        Take an idle gateway, checking that its session is still alive, or
+        join a new one if there is none
+        """
+        while True:
+            with self._lock:
+                idle = bool(self._idle)
+                gateway = self._idle.pop() if idle else None
+            if not idle:
+                gateway = self._join()
+            elif gateway is not self.conn and not gateway.keepAlive():
+                print("Pooled session is no longer alive, replacing it")
+                self._discard(gateway)
+                continue
+            if gateway is not self.conn:
+                gateway.SERVICE_OPTS.setOmeroGroup(
+                    self.conn.SERVICE_OPTS.getOmeroGroup())
+            return gateway
+
+    def release(self, gateway: BlitzGateway):
+        with self._lock:
+            self._idle.append(gateway)
+
+    @contextmanager
+    def gateway(self) -> Iterator[BlitzGateway]:
+        gateway = self.acquire()
+        try:
+            yield gateway
+        finally:
+            self.release(gateway)
+
+    def run(self, func: Callable[[BlitzGateway], Any]) -> Any:
+        """
+        Call ``func`` with a gateway from the pool
+        """
+        with self.gateway() as gateway:
+            return func(gateway)
+
+    def close(self):
+        """
+        Close all joined gateways, leaving the session of ``conn`` open
+        """
+        with self._lock:
+            joined, self._joined = self._joined, []
+            self._idle = [g for g in self._idle if g is self.conn]
+        for gateway in joined:
+            gateway.close(hard=False)
+        return
@@ -7,13 +7,28 @@
 # Use is subject to license terms supplied in LICENSE.
 
 from ome_types import from_xml
+from ome_types.model import OME, AnnotationRef, Dataset, ImageRef
 from omero.cli import CLI
 from omero.gateway import BlitzGateway
 from omero_cli_transfer import TransferControl
+from generate_omero_objects import parse_points, run_task_graph, Task
+from load_xml import load_transfer_xml, write_sidecar, load_sidecar
+from load_xml import find_transfer_xml, compress_transfer_xml
+from session_pool import SessionPool
+from journal import UnpackJournal
 
+import glob
 import pytest
 
 
+def strip_pixels(ome):
+    # drop what the fast loader does not keep of each Image's Pixels
+    for img in ome.images:
+        img.pixels = img.pixels.model_copy(update={
+            "channels": [], "planes": [], "tiff_data_blocks": [],
+            "bin_data_blocks": [], "metadata_only": None})
+
+
 class TestPackSide():
     def setup_method(self):
         self.cli = CLI()
@@ -82,6 +97,68 @@ class TestUnpackSide():
         assert str(folder.resolve()) == \
             "/omero-cli-transfer/test/data/valid_single_image"
 
+    @pytest.mark.parametrize("pack", sorted(glob.glob("test/data/*.zip") +
+                                            glob.glob("test/data/*.tar")))
+    def test_fast_xml(self, pack, tmp_path):
+        _, ome, folder = self.transfer._load_from_pack(pack,
+                                                       str(tmp_path / "pack"))
+        fast = load_transfer_xml(folder / "transfer.xml", validate=False)
+        strip_pixels(ome)
+        assert fast.projects == ome.projects
+        assert fast.datasets == ome.datasets
+        assert fast.screens == ome.screens
+        assert fast.plates == ome.plates
+        assert fast.images == ome.images
+        assert fast.structured_annotations == ome.structured_annotations
+        assert fast.rois == ome.rois
+
+    def test_sidecar(self, tmp_path):
+        pytest.importorskip("msgpack")
+        _, ome, folder = self.transfer._load_from_pack(
+            "test/data/simple_screen.zip", str(tmp_path / "pack"))
+        xml_path = folder / "transfer.xml"
+        assert load_sidecar(xml_path) is None
+        write_sidecar(ome, xml_path)
+        loaded = load_sidecar(xml_path)
+        assert loaded.model_dump() == ome.model_dump()
+        assert load_transfer_xml(xml_path).model_dump() == ome.model_dump()
+        with open(xml_path, 'a') as fp:
+            fp.write("\n")
+        assert load_sidecar(xml_path) is None
+
+    def test_sidecar_filled_in_place(self, tmp_path):
+        pytest.importorskip("msgpack")
+        _, src, folder = self.transfer._load_from_pack(
+            "test/data/simple_screen.zip", str(tmp_path / "pack"))
+        xml_path = folder / "transfer.xml"
+        # pack fills an empty model in place, as __append_to_ome does
+        ome = OME()
+        ome.images.extend(src.images)
+        ome.plates.extend(src.plates)
+        ome.screens.extend(src.screens)
+        ome.structured_annotations.extend(src.structured_annotations)
+        ome.images[0].annotation_refs.append(AnnotationRef(id=1))
+        write_sidecar(ome, xml_path)
+        loaded = load_sidecar(xml_path)
+        assert len(loaded.images) == len(src.images)
+        assert len(loaded.plates) == len(src.plates)
+        assert loaded.model_dump() == ome.model_dump()
+
+    @pytest.mark.parametrize("compression", ["gz", "zst"])
+    def test_compressed_xml(self, compression, tmp_path):
+        if compression == "zst":
+            pytest.importorskip("zstandard")
+        _, ome, folder = self.transfer._load_from_pack(
+            "test/data/simple_screen.zip", str(tmp_path / "pack"))
+        xml_path = compress_transfer_xml(folder / "transfer.xml", compression)
+        assert xml_path.name == f"transfer.xml.{compression}"
+        assert find_transfer_xml(folder) == xml_path
+        assert load_transfer_xml(xml_path) == ome
+        fast = load_transfer_xml(xml_path, validate=False)
+        # wells link to their images, which the fast loader prunes
+        strip_pixels(ome)
+        assert fast.plates == ome.plates
+
     def test_non_existing_file(self):
         with pytest.raises(FileNotFoundError):
             self.transfer._load_from_pack('data/fake_file.zip',
@@ -116,6 +193,125 @@ class TestUnpackSide():
         #                   filelist[0]))], int)
         assert True
 
+    def test_journal(self, tmp_path):
+        journal = UnpackJournal(tmp_path / "pack")
+        assert journal.path == tmp_path / "pack_journal.jsonl"
+        assert journal.is_empty()
+        journal.start("host", "user", 3, False)
+        assert journal.is_empty()
+        journal.record_phase("containers", ({"Project:1": 5}, {}, {}))
+        journal.record_import("a.tif", [10, 11], [], [40])
+        journal.record_img_map({"Image:1": 10, "Image:2": 11}, ["a.tif"])
+        journal.record_batch("rois", {"Image:1/ROI:1": 10})
+        journal.record_batch("rois", {"Image:2/ROI:2": 11})
+        journal.record_processed("a.tif")
+        with open(journal.path, 'a') as fp:
+            fp.write('{"step": "import", "pa')
+        resumed = UnpackJournal(tmp_path / "pack")
+        assert not resumed.is_empty()
+        resumed.start("host", "user", 3, False)
+        with pytest.raises(ValueError):
+            resumed.start("host", "user", 4, False)
+        with pytest.raises(ValueError):
+            resumed.start("host", "user", 3, True)
+        assert resumed.phases["containers"] == [{"Project:1": 5}, {}, {}]
+        assert resumed.imported == {"a.tif": [10, 11]}
+        assert resumed.imported_rois == {"a.tif": [40]}
+        assert resumed.img_map == {"Image:1": 10, "Image:2": 11}
+        assert resumed.mapped == {"a.tif"}
+        assert resumed.processed == {"a.tif"}
+        assert resumed.batches == {"rois": {"Image:1/ROI:1": 10,
+                                            "Image:2/ROI:2": 11}}
+        resumed.remove()
+        assert UnpackJournal(tmp_path / "pack").is_empty()
+        in_memory = UnpackJournal(tmp_path / "pack", persistent=False)
+        in_memory.start("host", "user", 3, True)
+        in_memory.record_processed("a.tif")
+        assert in_memory.processed == {"a.tif"}
+        assert not in_memory.path.exists()
+        in_memory.remove()
+
+    def test_parse_import_output(self, tmp_path):
+        output = tmp_path / "import.yml"
+        output.write_text("---\n"
+                          "- Fileset: 12\n"
+                          "  Image: [101, 102,103]\n"
+                          "- Fileset: 13\n"
+                          "  Plate: [7]\n"
+                          "  Image: [104]\n"
+                          "- Fileset: 14\n"
+                          "  Image: [105,\n"
+                          "    106]\n"
+                          "- Fileset: 15\n"
+                          "  Image:\n"
+                          "  - 107\n"
+                          "  - 108\n")
+        imported = self.transfer._parse_import_output(str(output))
+        assert imported["Fileset"] == [12, 13, 14, 15]
+        assert imported["Image"] == [101, 102, 103, 104, 105, 106, 107, 108]
+        assert imported["Plate"] == [7]
+        imported = self.transfer._parse_import_output(
+            str(tmp_path / "missing.yml"))
+        assert imported == {"Fileset": [], "Image": [], "Plate": []}
+
+    def test_parse_points(self):
+        points = ["1,2 3.5,4", "1,2, 3,4,", "-1e3,.5", "1,2,3 4,5"]
+        assert parse_points(points) == [[(1.0, 2.0), (3.5, 4.0)],
+                                        [(1.0, 2.0), (3.0, 4.0)],
+                                        [(-1000.0, 0.5)],
+                                        [(1.0, 2.0, 3.0), (4.0, 5.0)]]
+        with pytest.raises(ValueError):
+            parse_points(["1,2 3,x"])
+
+    def test_run_task_graph(self):
+        order = []
+
+        def step(name):
+            def func(conn, results):
+                order.append(name)
+                return name
+            return func
+        tasks = {
+            "links": Task(lambda c, r: r["containers"] + r["annotations"],
+                          ("containers", "annotations")),
+            "containers": Task(step("containers")),
+            "annotations": Task(step("annotations"), ("containers",)),
+        }
+        results = run_task_graph(tasks, None)
+        assert order == ["containers", "annotations"]
+        assert results["links"] == "containersannotations"
+        finished = {}
+        results = run_task_graph(tasks, None, done={"containers": "old"},
+                                 on_done=finished.__setitem__)
+        assert order == ["containers", "annotations", "annotations"]
+        assert finished == {"annotations": "annotations",
+                            "links": "oldannotations"}
+        with pytest.raises(ValueError):
+            run_task_graph({"a": Task(step("a"), ("b",))}, None)
+
+    def test_session_pool(self):
+        conn = BlitzGateway()
+        with SessionPool(conn, share_conn=True) as pool:
+            with pool.gateway() as gateway:
+                assert gateway is conn
+            assert pool.run(lambda c: c) is conn
+        assert pool.acquire() is conn
+
+    def test_import_targets(self):
+        ome = OME(datasets=[
+            Dataset(id="Dataset:1", image_refs=[ImageRef(id="Image:1"),
+                                                ImageRef(id="Image:2"),
+                                                ImageRef(id="Image:3")]),
+            Dataset(id="Dataset:2", image_refs=[ImageRef(id="Image:2"),
+                                                ImageRef(id="Image:4")])])
+        src_map = {"a.tif": [1], "b.czi": [1, 3], "c.czi": [1, 2],
+                   "d.czi": [3, 4], "e.czi": [3, 5], "f.pngmock_folder": [1]}
+        ds_map = {"Dataset:1": 11, "Dataset:2": 12}
+        targets = self.transfer._get_import_targets(ome, src_map, ds_map,
+                                                    {}, None)
+        assert targets == {"a.tif": "Dataset:11", "b.czi": "Dataset:11",
+                           "f.png": "Dataset:11"}
+
     def test_image_map(self):
         path1 = 'c/d'
         path2 = 'c/d'